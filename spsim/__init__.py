@@ -1 +1,14 @@
-from .simulation_functions import prepare_simulation
+"""
+Simulate single particle images from MD trajectories using parakeet.
+
+Submodules are imported on first use so that command line tools and dask
+workers only pay for the dependencies they need.
+"""
+__all__ = ['prepare_simulation']
+
+
+def __getattr__(name):
+    if name == 'prepare_simulation':
+        from .simulation_functions import prepare_simulation
+        return prepare_simulation
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,218 @@
+"""
+On-disk cache of simulated images, shared between simulations.
+
+Images are stored under a hash of everything which determines them: the
+content of the frame, the rotation, the defocus, the effective parakeet
+config and the versions of spsim and parakeet. Repeated or overlapping
+simulations only pay for images which are not already in the cache.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import socket
+from collections import Counter
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import NamedTuple, Optional
+from uuid import uuid4
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+# hits and misses in this process, keyed by cache directory
+_process_counts = Counter()
+_process_id = f'{socket.gethostname()}_{uuid4().hex}'
+
+# fraction of the size limit to which the cache is reduced when evicting
+EVICTION_TARGET = 0.9
+
+
+def package_version(*distribution_names: str) -> str:
+    for name in distribution_names:
+        try:
+            return version(name)
+        except PackageNotFoundError:
+            continue
+    return 'unknown'
+
+
+def image_cache_key(
+        frame_digest: str,
+        rotation: Rotation,
+        defocus: float,
+        parakeet_config: dict,
+        product: str = 'image',
+) -> str:
+    """Hash of all inputs which determine a simulated image.
+
+    The filename of the rotated structure is unique per image so is excluded
+    from the parakeet config. `product` distinguishes different outputs
+    simulated from the same inputs.
+    """
+    parakeet_config = json.loads(json.dumps(parakeet_config))
+    parakeet_config['sample']['coords'].pop('filename', None)
+
+    # q and -q represent the same rotation
+    quaternion = rotation.as_quat()
+    if quaternion[3] < 0:
+        quaternion = -quaternion
+
+    key_data = {
+        'frame': frame_digest,
+        'rotation': (np.round(quaternion, decimals=12) + 0.0).tolist(),
+        'defocus': float(defocus),
+        'parakeet_config': parakeet_config,
+        'product': product,
+        'spsim': package_version('spsim'),
+        'parakeet': package_version('python-parakeet', 'parakeet'),
+    }
+    encoded = json.dumps(key_data, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+
+    @property
+    def lookups(self):
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups > 0 else 0.0
+
+    def __sub__(self, other: 'CacheStats') -> 'CacheStats':
+        return CacheStats(self.hits - other.hits, self.misses - other.misses)
+
+
+class ImageCache:
+    """Size-bounded on-disk cache of simulated images.
+
+    The total size of the cache is tracked in a file updated under a lock,
+    least recently used images are only evicted once it grows beyond
+    `max_size_bytes`. Each process records its hits and misses in its own
+    file so statistics can be aggregated across workers.
+    """
+
+    def __init__(self, directory: os.PathLike, max_size_bytes: int):
+        self.directory = Path(directory).resolve()
+        self.max_size_bytes = max_size_bytes
+
+    @property
+    def images_directory(self) -> Path:
+        return self.directory / 'images'
+
+    @property
+    def stats_directory(self) -> Path:
+        return self.directory / 'stats'
+
+    @property
+    def size_file(self) -> Path:
+        return self.directory / 'size'
+
+    def path(self, key: str) -> Path:
+        return self.images_directory / key[:2] / f'{key}.npy'
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        path = self.path(key)
+        try:
+            image = np.load(path)
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, ValueError):
+            image = None
+        self._record_lookup(hit=image is not None)
+        return image
+
+    def put(self, key: str, image: np.ndarray):
+        """Atomically add an image to the cache then evict if necessary."""
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'.{path.name}.{uuid4().hex}')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, image)
+        try:
+            replaced_size = path.stat().st_size
+        except FileNotFoundError:
+            replaced_size = 0
+        os.replace(tmp_path, path)
+        self._update_size(path.stat().st_size - replaced_size)
+
+    def size(self) -> int:
+        """Total size of images in the cache as tracked by `put`, in bytes."""
+        try:
+            return int(self.size_file.read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _update_size(self, delta: int):
+        """Add `delta` bytes to the tracked size, evicting if over the limit.
+
+        The tracked size is approximate when processes race, it is reset to
+        the actual size whenever images are evicted.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.size_file, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                if content:
+                    size = int(content) + delta
+                else:  # not tracked yet, sweep to find the current size
+                    size = self.max_size_bytes + 1
+                if size > self.max_size_bytes:
+                    size = self.evict(EVICTION_TARGET * self.max_size_bytes)
+                f.seek(0)
+                f.truncate()
+                f.write(str(size))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def evict(self, target_size_bytes: Optional[float] = None) -> int:
+        """Remove least recently used images until the cache fits in a target size.
+
+        The target defaults to the size limit of the cache. This scans the
+        whole cache and returns its size after eviction in bytes.
+        """
+        if target_size_bytes is None:
+            target_size_bytes = self.max_size_bytes
+        entries = []
+        for path in self.images_directory.glob('*/*.npy'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= target_size_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+        return total_size
+
+    def _record_lookup(self, hit: bool):
+        counts_key = str(self.directory)
+        _process_counts[(counts_key, 'hits' if hit else 'misses')] += 1
+        counts = {
+            'hits': _process_counts[(counts_key, 'hits')],
+            'misses': _process_counts[(counts_key, 'misses')],
+        }
+        self.stats_directory.mkdir(parents=True, exist_ok=True)
+        stats_file = self.stats_directory / f'{_process_id}.json'
+        tmp_file = stats_file.with_name(f'.{stats_file.name}.{uuid4().hex}')
+        tmp_file.write_text(json.dumps(counts))
+        os.replace(tmp_file, stats_file)
+
+    def stats(self) -> CacheStats:
+        """Hits and misses aggregated over all processes which used the cache."""
+        hits, misses = 0, 0
+        for stats_file in self.stats_directory.glob('*.json'):
+            counts = json.loads(stats_file.read_text())
+            hits += counts['hits']
+            misses += counts['misses']
+        return CacheStats(hits=hits, misses=misses)
@@ -1,21 +1,32 @@
+"""
+Command line entry points.
+
+Only click is imported at module level, each command imports the
+dependencies it needs so that startup stays fast.
+"""
 from datetime import datetime
-from time import sleep
 
 import click
-import zarr
-from dask.distributed import Client
-from dask_jobqueue import SLURMCluster
-from humanize import naturaldelta
 
-from .simulation_functions import prepare_simulation
-from .utils import zarr2mrcs, json2star
 
 @click.command()
 @click.option(
     '--input-directory',
+    default=None,
     type=click.Path(exists=True),
-    prompt=True,
-    help='input directory containing structure files'
+    help='input directory containing structure files, one per frame'
+)
+@click.option(
+    '--topology-file',
+    default=None,
+    type=click.Path(exists=True),
+    help='structure file defining atoms in the trajectory (alternative to --input-directory)'
+)
+@click.option(
+    '--trajectory-file',
+    default=None,
+    type=click.Path(exists=True),
+    help='trajectory file (e.g. dcd/xtc) containing frames (alternative to --input-directory)'
 )
 @click.option(
     '--output-basename',
@@ -62,8 +73,62 @@ from .utils import zarr2mrcs, json2star
     prompt=True,
     help='number of gpus to request for this simulation'
 )
+@click.option(
+    '--output-sidelength',
+    default=None,
+    type=int,
+    help='Fourier crop images to this sidelength before storage'
+)
+@click.option(
+    '--normalise/--no-normalise',
+    default=False,
+    help='normalise image background to zero mean and unit standard deviation'
+)
+@click.option(
+    '--mask-radius',
+    default=None,
+    type=float,
+    help='radius of circular mask applied to stored images in pixels'
+)
+@click.option(
+    '--output-dtype',
+    default='float16',
+    type=click.Choice(['float16', 'float32']),
+    help='data type of stored images'
+)
+@click.option(
+    '--output-format',
+    default='zarr',
+    type=click.Choice(['zarr', 'relion']),
+    help="'relion' writes mrcs files and a STAR file directly during simulation"
+)
+@click.option(
+    '--cache-directory',
+    default=None,
+    type=click.Path(file_okay=False),
+    help='directory of image cache shared between simulations, disabled if not set'
+)
+@click.option(
+    '--cache-max-size-gb',
+    default=100,
+    type=float,
+    help='maximum size of the image cache, least recently used images are evicted'
+)
+@click.option(
+    '--noiseless/--noisy',
+    default=False,
+    help='store expected images, noise can then be generated at any dose with spsim.noise'
+)
+@click.option(
+    '--max-retries',
+    default=3,
+    type=int,
+    help='number of times an image is retried after a retryable failure (e.g. GPU out of memory)'
+)
 def spsim_scarf(
         input_directory,
+        topology_file,
+        trajectory_file,
         output_basename,
         n_images,
         image_sidelength,
@@ -71,7 +136,23 @@ def spsim_scarf(
         max_defocus,
         random_seed,
         n_gpus,
+        output_sidelength,
+        normalise,
+        mask_radius,
+        output_dtype,
+        output_format,
+        cache_directory,
+        cache_max_size_gb,
+        noiseless,
+        max_retries,
 ):
+    from dask.distributed import Client
+    from dask_jobqueue import SLURMCluster
+    from humanize import naturaldelta
+
+    from .data_model import PostProcessingConfig
+    from .simulation_functions import prepare_simulation
+
     # prepare computational resources
     SCARF_GPU_CONFIG = {
         'queue': 'gpu',
@@ -91,11 +172,23 @@ def spsim_scarf(
     # create simulation
     simulation = prepare_simulation(
         input_directory=input_directory,
+        topology_file=topology_file,
+        trajectory_file=trajectory_file,
         output_basename=output_basename,
         n_images=n_images,
         image_sidelength=image_sidelength,
         defocus_range=(min_defocus, max_defocus),
-        random_seed=random_seed
+        random_seed=random_seed,
+        postprocessing=PostProcessingConfig(
+            output_sidelength=output_sidelength,
+            normalise=normalise,
+            mask_radius=mask_radius,
+            dtype=output_dtype,
+        ),
+        output_format=output_format,
+        cache_directory=cache_directory,
+        cache_max_size_gb=cache_max_size_gb,
+        noiseless=noiseless,
     )
 
     click.echo('\n')
@@ -109,8 +202,8 @@ def spsim_scarf(
     click.echo(f'http://localhost:8787/')
     click.echo('on your local machine\n')
 
-    n_structure_files = len(simulation.config.structure_files)
-    click.echo(f'simulating {n_images} images from {n_structure_files} structure files')
+    n_frames = len(simulation.config.frame_source)
+    click.echo(f'simulating {n_images} images from {n_frames} frames')
     click.echo(f'simulation will request short term use of {n_gpus} GPUs using SLURM')
     click.echo(f'job walltimes are short, your jobs will not block others for long!')
     start_time = datetime.now()
@@ -121,34 +214,58 @@ def spsim_scarf(
         f.write(simulation.json())
     click.echo(f"simulation params stored in '{jf}'")
 
-    zf = simulation.zarr_filename
-    click.echo(f"results stored in '{zf}'\n")
+    if simulation.config.statistics is not None:
+        click.echo(f"per-image statistics stored in '{simulation.statistics_filename}'")
+    if simulation.config.output_format == 'relion':
+        click.echo(f"particles stored in '{simulation.star_filename}'")
+        click.echo(f"images stored in {len(simulation.mrcs_filenames)} mrcs file(s)\n")
+    else:
+        click.echo(f"results stored in '{simulation.zarr_filename}'\n")
 
     click.echo(f'submitting computations to the cluster takes time')
     click.echo(f'once all jobs are submitted, status of simulation will be printed to the console')
     click.echo(f'\n')
 
-    simulation.execute(client)
-
-    za = zarr.convenience.open(zf)
+    image_cache = simulation.image_cache
+    if image_cache is not None:
+        click.echo(f"using image cache in '{image_cache.directory}'\n")
+        cache_stats_before = image_cache.stats()
 
-    while za.nchunks_initialized < za.nchunks:
+    def report_progress(n_succeeded, n_failed):
         now = datetime.now()
-        particles_simulated = za.nchunks_initialized
-        particles_simulated_str = f'{particles_simulated} / {n_images} particles simulated'
+        particles_simulated_str = f'{n_succeeded} / {n_images} particles simulated'
+        if n_failed > 0:
+            particles_simulated_str += f' ({n_failed} failed)'
         elapsed_time = naturaldelta(now - start_time, minimum_unit='seconds')
 
-        if particles_simulated > 0:
-            time_per_particle = (now - start_time).total_seconds() / particles_simulated
+        if n_succeeded > 0:
+            time_per_particle = (now - start_time).total_seconds() / n_succeeded
         else:
             time_per_particle = 9999.99
         click.echo(
             f'{particles_simulated_str} in {elapsed_time} (avg. {time_per_particle:.2f}s per particle)        \r',
             nl=False
         )
-        sleep(0.1)
+
+    outcomes = simulation.execute(
+        client, max_retries=max_retries, progress=report_progress
+    )
     click.echo(f'done!')
 
+    n_failed = sum(outcome.status != 'success' for outcome in outcomes)
+    if n_failed > 0:
+        click.echo(
+            f'{n_failed} images could not be simulated, '
+            f"see '{simulation.failure_manifest_filename}'"
+        )
+
+    if image_cache is not None:
+        cache_stats = image_cache.stats() - cache_stats_before
+        click.echo(
+            f'image cache: {cache_stats.hits} / {cache_stats.lookups} images '
+            f'reused ({cache_stats.hit_rate:.1%} hit rate)'
+        )
+
 
 @click.command()
 @click.option(
@@ -163,8 +280,10 @@ def spsim_scarf(
     prompt=True,
     help='output mrcs file'
 )
-def zarr2mrcs_cli(input_zarr_file, mrcs_file):
-    zarr2mrcs(input_zarr_file, mrcs_file)
+def zarr2mrcs_cli(input_zarr_file, output_mrcs_file):
+    from .utils import zarr2mrcs
+
+    zarr2mrcs(input_zarr_file, output_mrcs_file)
     return
 
 
@@ -182,5 +301,86 @@ def zarr2mrcs_cli(input_zarr_file, mrcs_file):
     help='output mrcs file'
 )
 def json2star_cli(input_json_file, output_star_file):
+    from .utils import json2star
+
     json2star(input_json_file, output_star_file)
-    return
\ No newline at end of file
+    return
+
+
+@click.command()
+@click.option(
+    '--input-zarr-file',
+    type=click.Path(exists=True),
+    prompt=True,
+    help='zarr file containing images from a noiseless simulation',
+)
+@click.option(
+    '--output-zarr-file',
+    type=click.Path(exists=False),
+    prompt=True,
+    help='output zarr file for noisy images'
+)
+@click.option(
+    '--dose',
+    type=float,
+    multiple=True,
+    required=True,
+    help='dose in electrons per square angstrom, can be provided multiple times'
+)
+@click.option(
+    '--n-realisations',
+    default=1,
+    type=int,
+    help='number of noise realisations per dose'
+)
+@click.option(
+    '--random-seed',
+    default=None,
+    type=int,
+    help='random seed for reproducing identical noise realisations'
+)
+def noise_cli(input_zarr_file, output_zarr_file, dose, n_realisations, random_seed):
+    from .noise import write_noise_realisations
+
+    write_noise_realisations(
+        input_zarr_file=input_zarr_file,
+        output_zarr_file=output_zarr_file,
+        doses=dose,
+        n_realisations=n_realisations,
+        random_seed=random_seed,
+    )
+    return
+
+
+@click.command()
+@click.option(
+    '--input-statistics-directory',
+    type=click.Path(exists=True, file_okay=False),
+    prompt=True,
+    help='statistics directory written during a simulation',
+)
+@click.option(
+    '--output-basename',
+    type=str,
+    prompt=True,
+    help='basename for output statistics, defocus averages and QC plots'
+)
+@click.option(
+    '--n-defocus-bins',
+    default=5,
+    type=int,
+    help='number of defocus bins for average images'
+)
+def stats_cli(input_statistics_directory, output_basename, n_defocus_bins):
+    from .statistics import write_statistics_report
+
+    outputs = write_statistics_report(
+        statistics_directory=input_statistics_directory,
+        output_basename=output_basename,
+        n_defocus_bins=n_defocus_bins,
+    )
+    for name, filename in outputs.items():
+        click.echo(f"{name.replace('_', ' ')} written to '{filename}'")
+    if 'plots' not in outputs:
+        click.echo('install matplotlib to generate QC plots')
+    return
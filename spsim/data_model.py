@@ -2,7 +2,7 @@ from typing import Sequence
 from pydantic import BaseModel, confloat, conint, FilePath, DirectoryPath, validator, \
     ValidationError
 from scipy.spatial.transform import Rotation
-from typing import Sequence, NamedTuple
+from typing import Sequence, NamedTuple, Optional, Literal, Tuple
 from functools import cached_property
 import pathlib
 import numpy as np
@@ -10,20 +10,33 @@ from copy import deepcopy
 from datetime import datetime
 
 from pydantic import BaseModel, confloat, conint, FilePath, DirectoryPath, validator, \
-    ValidationError
+    ValidationError, root_validator, PrivateAttr
+from pydantic.error_wrappers import ErrorWrapper
 from scipy.spatial.transform import Rotation
-from dask.distributed import Client
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from dask.distributed import Client
+
+from .cache import ImageCache, image_cache_key
+from .frames import (
+    FrameSource,
+    StructureFileFrameSource,
+    TrajectoryFrameSource,
+)
 
 from .rotation import generate_uniform_rotations, rotation_to_relion_eulers
 from .typing import DefocusRange
 from .parakeet_interface import CONFIG_TEMPLATE
+from .relion import shard_location, shard_sizes
 from .utils import generate_parakeet_config
 
 
 class SingleImageParameters(BaseModel):
     """Parameters for a single image in a single-particle simulation.
     """
-    input_structure: pathlib.Path
+    frame_index: conint(ge=0)
+    frame_name: Optional[str] = None
     rotation: Rotation
     defocus: confloat(gt=0, lt=10)
 
@@ -34,45 +47,197 @@ class SingleImageParameters(BaseModel):
             Rotation: rotation_to_relion_eulers,
         }
 
-    @validator('input_structure', allow_reuse=True)
-    def resolve_path(cls, v):
-        return v.resolve()
-
     @cached_property
     def rotated_structure_filename(self):
-        stem = self.input_structure.stem
+        stem = self.frame_name or f'frame{self.frame_index:06d}'
         timestamp = datetime.utcnow().strftime(format="%y%m%d%H%M%S%f")
         unique_id = id(self)
         return f'{stem}_{timestamp}_{unique_id}.cif'
 
 
+class ImageOutcome(BaseModel):
+    """Outcome of an attempt to simulate a single image.
+
+    Retryable failures come from the environment (e.g. a parakeet stage
+    running out of GPU memory) and may succeed on another worker, fatal
+    failures will not.
+    """
+    idx: int
+    status: Literal['success', 'retryable', 'fatal']
+    attempt: int = 1
+    worker: Optional[str] = None
+    stage: Optional[str] = None
+    returncode: Optional[int] = None
+    error: Optional[str] = None
+
+
+class PostProcessingConfig(BaseModel):
+    """Post-processing applied to each image before it is stored.
+
+    Images are Fourier cropped to `output_sidelength`, normalised such that
+    the background outside `background_radius` has zero mean and unit standard
+    deviation, masked with a circular mask of radius `mask_radius` then
+    converted to `dtype`. Radii are in pixels of the output image.
+    """
+    output_sidelength: Optional[conint(gt=0, multiple_of=2)] = None
+    normalise: bool = False
+    background_radius: Optional[confloat(gt=0)] = None
+    mask_radius: Optional[confloat(gt=0)] = None
+    mask_soft_edge_width: confloat(ge=0) = 0
+    dtype: Literal['float16', 'float32'] = 'float16'
+
+
+class StatisticsConfig(BaseModel):
+    """Summary statistics computed for each image before it is stored.
+
+    Histograms have `histogram_bins` bins over `histogram_range` plus one bin
+    at each end for values outside the range. If no range is given it is
+    derived from the post-processing of the simulation. Thumbnails are Fourier
+    cropped to `thumbnail_sidelength`, or the output sidelength if smaller.
+    """
+    histogram_bins: conint(gt=0) = 256
+    histogram_range: Optional[Tuple[float, float]] = None
+    thumbnail_sidelength: conint(gt=0, multiple_of=2) = 64
+
+
 class SimulationConfig(BaseModel):
-    """Global parameters defining an entire single-particle simulation"""
-    input_directory: DirectoryPath
+    """Global parameters defining an entire single-particle simulation
+
+    Frames come from either a directory of structure files or a topology
+    file and a trajectory file.
+    """
+    input_directory: Optional[DirectoryPath] = None
+    topology_file: Optional[FilePath] = None
+    trajectory_file: Optional[FilePath] = None
     n_images: conint(gt=0)
     image_sidelength: conint(gt=0, multiple_of=2)
     defocus_range: DefocusRange
     output_basename: str
+    postprocessing: PostProcessingConfig = PostProcessingConfig()
+    output_format: Literal['zarr', 'relion'] = 'zarr'
+    images_per_shard: conint(gt=0) = 10000
+    cache_directory: Optional[pathlib.Path] = None
+    cache_max_size_gb: confloat(gt=0) = 100
+    noiseless: bool = False
+    statistics: Optional[StatisticsConfig] = StatisticsConfig()
 
-    @validator('input_directory')
-    def contains_structure_files(cls, value: DirectoryPath):
-        matches = [
-            f for f in value.iterdir()
-            if (f.match('*.pdb') or f.match('*.cif'))
-        ]
-        if len(matches) < 1:
+    _frame_source: Optional[FrameSource] = PrivateAttr(default=None)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        # checked here so the directory listing is cached in the frame source
+        if self.input_directory is not None and len(self.frame_source) == 0:
+            error = ValueError(
+                f'directory {self.input_directory} contains no structure files '
+                f'(cif/pdb)'
+            )
+            raise ValidationError(
+                [ErrorWrapper(error, loc='input_directory')], self.__class__
+            )
+
+    @validator('input_directory', 'topology_file', 'trajectory_file', 'cache_directory')
+    def resolve_path(cls, v):
+        return v.resolve() if v is not None else v
+
+    @root_validator(skip_on_failure=True)
+    def exactly_one_frame_source(cls, values):
+        input_directory = values.get('input_directory')
+        trajectory_files = (values.get('topology_file'), values.get('trajectory_file'))
+        if input_directory is not None and any(trajectory_files):
             raise ValueError(
-                f'directory {value} contains no structure files (cif/pdb)'
+                'provide either an input directory or topology and trajectory '
+                'files, not both'
+            )
+        if input_directory is None and not all(trajectory_files):
+            raise ValueError(
+                'provide either an input directory or topology and trajectory files'
+            )
+        return values
+
+    @validator('postprocessing')
+    def output_sidelength_not_larger(cls, value: PostProcessingConfig, values):
+        image_sidelength = values.get('image_sidelength')
+        if (
+                value.output_sidelength is not None
+                and image_sidelength is not None
+                and value.output_sidelength > image_sidelength
+        ):
+            raise ValueError(
+                f'output sidelength ({value.output_sidelength}) must not be '
+                f'larger than image sidelength ({image_sidelength})'
             )
         return value
 
+    @validator('noiseless')
+    def noiseless_output_is_zarr(cls, value: bool, values):
+        if value is True and values.get('output_format') != 'zarr':
+            raise ValueError('noiseless simulations must be stored as zarr')
+        return value
+
     @property
-    def structure_files(self):
-        matches = [
-            f for f in self.input_directory.rglob('*')
-            if (f.match('*.pdb') or f.match('*.cif'))
-        ]
-        return matches
+    def effective_postprocessing(self) -> PostProcessingConfig:
+        """post-processing applied to images before they are stored
+
+        Noiseless images are expected intensities from which noise is
+        generated later so they are only Fourier cropped and stored as float32.
+        """
+        if self.noiseless:
+            return PostProcessingConfig(
+                output_sidelength=self.postprocessing.output_sidelength,
+                dtype='float32',
+            )
+        return self.postprocessing
+
+    @property
+    def output_sidelength(self):
+        """sidelength of stored images after post-processing"""
+        return self.postprocessing.output_sidelength or self.image_sidelength
+
+    @property
+    def simulated_pixel_size(self):
+        """pixel size of images simulated by parakeet, angstroms"""
+        return CONFIG_TEMPLATE['microscope']['detector']['pixel_size']
+
+    @property
+    def output_pixel_size(self):
+        """pixel size of stored images after post-processing, angstroms"""
+        binning = self.image_sidelength / self.output_sidelength
+        return self.simulated_pixel_size * binning
+
+    @property
+    def histogram_range(self) -> Tuple[float, float]:
+        """range of per-image histograms, derived from post-processing if not set
+
+        Normalised images span a few standard deviations around zero and
+        noiseless images are intensities around one. Otherwise images are
+        inverted electron counts, the range spans ten standard deviations of
+        Poisson noise around the mean count per pixel before cropping
+        (Fourier cropping preserves the mean).
+        """
+        if self.statistics.histogram_range is not None:
+            return self.statistics.histogram_range
+        if self.noiseless:
+            return 0, 2
+        if self.postprocessing.normalise:
+            return -10, 10
+        beam = CONFIG_TEMPLATE['microscope']['beam']
+        pixel_size = CONFIG_TEMPLATE['microscope']['detector']['pixel_size']
+        mean_count = beam['electrons_per_angstrom'] * pixel_size ** 2
+        spread = 10 * np.sqrt(mean_count)
+        return -(mean_count + spread), -max(mean_count - spread, 0)
+
+    @property
+    def frame_source(self) -> FrameSource:
+        """source of frames for the simulation, created once on first access"""
+        if self._frame_source is None:
+            if self.input_directory is not None:
+                self._frame_source = StructureFileFrameSource(self.input_directory)
+            else:
+                self._frame_source = TrajectoryFrameSource(
+                    topology_file=self.topology_file,
+                    trajectory_file=self.trajectory_file,
+                )
+        return self._frame_source
 
 
 class Simulation(BaseModel):
@@ -92,9 +257,9 @@ class Simulation(BaseModel):
         # random number generator for reproducibility
         rng = np.random.default_rng(random_seed)
 
-        # n uniform samples from structure files in input directory
-        structure_file_samples = rng.choice(
-            config.structure_files,
+        # n uniform samples from frames in the frame source
+        frame_indices = rng.choice(
+            len(config.frame_source),
             size=config.n_images,
             replace=True
         )
@@ -111,8 +276,13 @@ class Simulation(BaseModel):
 
         # create per-image simulation parameters
         image_parameters = [
-            SingleImageParameters(input_structure=i, rotation=r, defocus=d)
-            for i, r, d in zip(structure_file_samples, rotations, defoci)
+            SingleImageParameters(
+                frame_index=i,
+                frame_name=config.frame_source.frame_name(i),
+                rotation=r,
+                defocus=d,
+            )
+            for i, r, d in zip(frame_indices, rotations, defoci)
         ]
 
         return cls(
@@ -144,28 +314,101 @@ class Simulation(BaseModel):
     def __len__(self):
         return self.config.n_images
 
+    @property
+    def image_cache(self) -> Optional[ImageCache]:
+        """cache of simulated images shared between simulations, if enabled"""
+        if self.config.cache_directory is None:
+            return None
+        return ImageCache(
+            directory=self.config.cache_directory,
+            max_size_bytes=int(self.config.cache_max_size_gb * 1e9),
+        )
+
+    def image_cache_key(self, idx: int) -> str:
+        image_parameters = self.per_image_parameters[idx]
+        return image_cache_key(
+            frame_digest=self.config.frame_source.frame_digest(
+                image_parameters.frame_index
+            ),
+            rotation=image_parameters.rotation,
+            defocus=image_parameters.defocus,
+            parakeet_config=self.parakeet_config_files[idx],
+            product='optics' if self.config.noiseless else 'image',
+        )
+
     @property
     def zarr_filename(self):
         return f'{self.config.output_basename}.zarr'
 
-    def simulate_image(self, idx: int):
+    @property
+    def statistics_filename(self):
+        return f'{self.config.output_basename}.stats'
+
+    @property
+    def thumbnail_sidelength(self):
+        return min(
+            self.config.statistics.thumbnail_sidelength, self.config.output_sidelength
+        )
+
+    @property
+    def failure_manifest_filename(self):
+        return f'{self.config.output_basename}.failures.json'
+
+    @property
+    def star_filename(self):
+        return f'{self.config.output_basename}.star'
+
+    @property
+    def mrcs_filenames(self):
+        n_shards = len(shard_sizes(len(self), self.config.images_per_shard))
+        return [
+            f'{self.config.output_basename}_{shard:04d}.mrcs'
+            for shard in range(n_shards)
+        ]
+
+    def mrcs_location(self, idx: int):
+        """mrcs file and index within that file for a given image"""
+        shard, shard_idx = shard_location(idx, self.config.images_per_shard)
+        return self.mrcs_filenames[shard], shard_idx
+
+    def simulate_image(self, idx: int, retry: bool = False):
         if 0 > idx > len(self):
             raise IndexError
-        from .simulation_functions import simulate_single_image
-        return simulate_single_image(simulation=self, idx=idx, zarr_filename=self.zarr_filename)
+        from .simulation_functions import simulate_single_image, save_image
+        image = simulate_single_image(simulation=self, idx=idx)
+        save_image(simulation=self, image=image, idx=idx, retry=retry)
+        return image
 
-    def as_dask_array(self):
+    def as_dask_array(self, images_per_chunk: int = 1):
         from .simulation_functions import simulation_as_dask_array
-        return simulation_as_dask_array(self, self.zarr_filename)
+        return simulation_as_dask_array(self, images_per_chunk=images_per_chunk)
 
     def create_zarr_store(self):
         """"creates a zarr store for the results of the simulation"""
         from .simulation_functions import create_zarr_store
         return create_zarr_store(simulation=self)
 
-    def execute(self, client: Client):
+    def create_relion_output(self):
+        """creates mrcs shards and a STAR file for the results of the simulation"""
+        from .simulation_functions import create_relion_output
+        return create_relion_output(simulation=self)
+
+    def create_statistics_store(self):
+        """creates a zarr store for per-image statistics of the simulation"""
+        from .simulation_functions import create_statistics_store
+        return create_statistics_store(simulation=self)
+
+    def create_output(self):
+        """creates output files in the format defined by the simulation config"""
+        if self.config.statistics is not None:
+            self.create_statistics_store()
+        if self.config.output_format == 'relion':
+            return self.create_relion_output()
+        return self.create_zarr_store()
+
+    def execute(self, client: "Client", **kwargs):
         from .simulation_functions import execute
-        return execute(simulation=self, client=client)
+        return execute(simulation=self, client=client, **kwargs)
 
 
 
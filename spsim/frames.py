@@ -0,0 +1,268 @@
+"""
+Sources of MD frames from which particle images are simulated.
+
+Frames are indexed from zero and loaded lazily as gemmi structures.
+Frames can come from a directory of structure files (one file per frame) or
+from a topology file plus a trajectory file.
+"""
+import hashlib
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, List
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import gemmi
+
+STRUCTURE_FILE_PATTERNS = ('*.pdb', '*.cif')
+
+
+def is_structure_file(path: Path) -> bool:
+    return any(path.match(pattern) for pattern in STRUCTURE_FILE_PATTERNS)
+
+
+def file_digest(filename: os.PathLike) -> str:
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FrameSource:
+    """Base class for an indexable set of MD frames."""
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def load_frame(self, idx: int) -> "gemmi.Structure":
+        raise NotImplementedError
+
+    def frame_name(self, idx: int) -> str:
+        """short name for a frame, used when naming intermediate files"""
+        return f'frame{idx:06d}'
+
+    def frame_digest(self, idx: int) -> str:
+        """hash of the content of a frame, independent of where it is stored"""
+        raise NotImplementedError
+
+
+class StructureFileFrameSource(FrameSource):
+    """Frames stored as individual pdb/cif files in a directory.
+
+    The directory is scanned recursively once, on first access, and files are
+    sorted so that frame indices are stable across machines.
+    """
+
+    def __init__(self, directory: os.PathLike):
+        self.directory = Path(directory)
+        self._files = None
+
+    @property
+    def files(self) -> List[Path]:
+        if self._files is None:
+            self._files = sorted(
+                f for f in self.directory.rglob('*') if is_structure_file(f)
+            )
+        return self._files
+
+    def __len__(self):
+        return len(self.files)
+
+    def load_frame(self, idx: int) -> "gemmi.Structure":
+        import gemmi
+
+        return gemmi.read_structure(str(self.files[idx]))
+
+    def frame_name(self, idx: int) -> str:
+        return self.files[idx].stem
+
+    def frame_digest(self, idx: int) -> str:
+        return file_digest(self.files[idx])
+
+
+class DCDFile:
+    """Memory-mapped, read-only access to coordinates in a DCD file.
+
+    DCD frames have a fixed size so frames are read directly from a memory
+    map without loading the whole trajectory. Files with fixed atoms or four
+    dimensional coordinates are not supported.
+    """
+
+    def __init__(self, filename: os.PathLike):
+        self.filename = Path(filename)
+        self._read_header()
+        self._frames = None
+
+    def _read_header(self):
+        with open(self.filename, 'rb') as f:
+            header_marker = np.fromfile(f, dtype='<i4', count=1)[0]
+            byteorder = '<' if header_marker == 84 else '>'
+            int32 = np.dtype(f'{byteorder}i4')
+
+            f.seek(4)
+            if f.read(4) != b'CORD':
+                raise ValueError(f'{self.filename} is not a DCD file')
+            control = np.fromfile(f, dtype=int32, count=20)
+            f.seek(4, os.SEEK_CUR)
+
+            title_marker = np.fromfile(f, dtype=int32, count=1)[0]
+            f.seek(title_marker + 4, os.SEEK_CUR)
+
+            f.seek(4, os.SEEK_CUR)
+            self.n_atoms = int(np.fromfile(f, dtype=int32, count=1)[0])
+            f.seek(4, os.SEEK_CUR)
+            self._header_size = f.tell()
+
+        n_fixed_atoms, has_unit_cell, has_4d = control[8], control[10], control[11]
+        is_charmm = control[19] != 0
+        if n_fixed_atoms > 0 or (is_charmm and has_4d):
+            raise NotImplementedError(
+                f'{self.filename} contains fixed atoms or 4D coordinates'
+            )
+        self._byteorder = byteorder
+
+        # frames are (unit cell), x, y, z records, each with 4 byte markers
+        unit_cell_size = 4 + 48 + 4 if (is_charmm and has_unit_cell) else 0
+        self._coordinate_offset = unit_cell_size // 4 + 1
+        self._record_size = self.n_atoms + 2
+        self._frame_size = unit_cell_size // 4 + 3 * self._record_size
+
+    @property
+    def frames(self) -> np.memmap:
+        if self._frames is None:
+            n_values = (os.path.getsize(self.filename) - self._header_size) // 4
+            self._frames = np.memmap(
+                self.filename,
+                dtype=f'{self._byteorder}f4',
+                mode='r',
+                offset=self._header_size,
+                shape=(n_values // self._frame_size, self._frame_size),
+            )
+        return self._frames
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def coordinates(self, idx: int) -> np.ndarray:
+        """(n_atoms, 3) array of coordinates for a single frame"""
+        frame = self.frames[idx]
+        xyz = [
+            frame[start:start + self.n_atoms]
+            for start in (
+                self._coordinate_offset + i * self._record_size
+                for i in range(3)
+            )
+        ]
+        return np.stack(xyz, axis=-1).astype(np.float64)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_frames'] = None
+        return state
+
+
+class MDAnalysisTrajectory:
+    """Lazy access to coordinates in any trajectory format read by MDAnalysis.
+
+    MDAnalysis indexes frame offsets so random access does not read the
+    whole trajectory.
+    """
+
+    def __init__(self, topology_file: os.PathLike, trajectory_file: os.PathLike):
+        self.topology_file = Path(topology_file)
+        self.trajectory_file = Path(trajectory_file)
+        self._universe = None
+
+    @property
+    def universe(self):
+        if self._universe is None:
+            try:
+                import MDAnalysis
+            except ImportError as e:
+                raise ImportError(
+                    f'reading {self.trajectory_file.suffix} trajectories '
+                    f'requires MDAnalysis'
+                ) from e
+            self._universe = MDAnalysis.Universe(
+                str(self.topology_file), str(self.trajectory_file)
+            )
+        return self._universe
+
+    def __len__(self):
+        return len(self.universe.trajectory)
+
+    def coordinates(self, idx: int) -> np.ndarray:
+        """(n_atoms, 3) array of coordinates for a single frame"""
+        self.universe.trajectory[idx]
+        return self.universe.atoms.positions.astype(np.float64)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_universe'] = None
+        return state
+
+
+class TrajectoryFrameSource(FrameSource):
+    """Frames from a topology file and a trajectory file.
+
+    The topology is read with gemmi and must contain atoms in the same order
+    as the trajectory. DCD trajectories are memory-mapped, other formats are
+    read lazily with MDAnalysis.
+    """
+
+    def __init__(self, topology_file: os.PathLike, trajectory_file: os.PathLike):
+        self.topology_file = Path(topology_file)
+        self.trajectory_file = Path(trajectory_file)
+        self._topology = None
+        self._trajectory = None
+        self._topology_digest = None
+
+    @property
+    def topology(self) -> "gemmi.Structure":
+        if self._topology is None:
+            import gemmi
+
+            self._topology = gemmi.read_structure(str(self.topology_file))
+        return self._topology
+
+    @property
+    def trajectory(self):
+        if self._trajectory is None:
+            if self.trajectory_file.suffix.lower() == '.dcd':
+                self._trajectory = DCDFile(self.trajectory_file)
+            else:
+                self._trajectory = MDAnalysisTrajectory(
+                    self.topology_file, self.trajectory_file
+                )
+        return self._trajectory
+
+    def __len__(self):
+        return len(self.trajectory)
+
+    def load_frame(self, idx: int) -> "gemmi.Structure":
+        from .gemmi import update_xyz_in_model
+
+        structure = self.topology.clone()
+        xyz = self.trajectory.coordinates(idx)
+        if structure[0].count_atom_sites() != len(xyz):
+            raise ValueError(
+                f'{self.topology_file} and {self.trajectory_file} contain '
+                f'different numbers of atoms'
+            )
+        update_xyz_in_model(structure[0], xyz)
+        return structure
+
+    def frame_digest(self, idx: int) -> str:
+        if self._topology_digest is None:
+            self._topology_digest = file_digest(self.topology_file)
+        digest = hashlib.sha256(self._topology_digest.encode())
+        digest.update(self.trajectory.coordinates(idx).tobytes())
+        return digest.hexdigest()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_topology'] = None
+        state['_trajectory'] = None
+        return state
@@ -0,0 +1,139 @@
+"""
+Poisson noise realisations at chosen doses from noiseless simulations.
+
+Noiseless simulations store the expected image intensity per incident
+electron. Noisy images at any dose are generated from these by drawing
+electron counts from a Poisson distribution, so one simulation can provide
+dose series and many independent noise realisations.
+"""
+from typing import Optional, Sequence
+
+import numpy as np
+import zarr
+from dask import array as da
+
+from .data_model import PostProcessingConfig
+from .postprocessing import finalise_image
+
+
+def poisson_noise_block(
+        expected: np.ndarray,
+        electrons_per_pixel: float,
+        seed: Sequence[int],
+        scale: float = 1,
+        block_info=None,
+) -> np.ndarray:
+    """Draw inverted electron counts for a chunk of expected images.
+
+    Counts are multiplied by `scale`. Each chunk gets an independent random
+    stream derived from `seed` and the position of the chunk so results do not
+    depend on how chunks are scheduled.
+    """
+    chunk_location = block_info[0]['chunk-location']
+    seed_sequence = np.random.SeedSequence([*seed, *chunk_location])
+    rng = np.random.default_rng(seed_sequence)
+    counts = rng.poisson(np.clip(expected, 0, None) * electrons_per_pixel)
+    return (counts * -scale).astype(np.float32)
+
+
+def add_poisson_noise(
+        expected: da.Array,
+        electrons_per_angstrom: float,
+        pixel_size: float,
+        seed: Sequence[int],
+        simulated_pixel_size: Optional[float] = None,
+) -> da.Array:
+    """Lazily generate noisy images from a stack of expected images.
+
+    Images are inverted to match images from noisy simulations. If expected
+    images were Fourier cropped from images with `simulated_pixel_size`,
+    counts are drawn for the larger pixels of `pixel_size` then rescaled to
+    counts per simulated pixel. This matches the mean and noise of noisy
+    simulations which are Fourier cropped, as cropping preserves the mean.
+    """
+    simulated_pixel_size = simulated_pixel_size or pixel_size
+    electrons_per_pixel = electrons_per_angstrom * pixel_size ** 2
+    return expected.map_blocks(
+        poisson_noise_block,
+        electrons_per_pixel=electrons_per_pixel,
+        seed=tuple(seed),
+        scale=(simulated_pixel_size / pixel_size) ** 2,
+        dtype=np.float32,
+    )
+
+
+def noisy_images(
+        expected: da.Array,
+        electrons_per_angstrom: float,
+        pixel_size: float,
+        postprocessing: PostProcessingConfig,
+        seed: Sequence[int],
+        simulated_pixel_size: Optional[float] = None,
+) -> da.Array:
+    """Lazily generate noisy, post-processed images from expected images.
+
+    Expected images are assumed to have already been Fourier cropped from
+    images with `simulated_pixel_size` to `pixel_size`.
+    """
+    expected = expected.rechunk({1: -1, 2: -1})
+    noisy = add_poisson_noise(
+        expected,
+        electrons_per_angstrom=electrons_per_angstrom,
+        pixel_size=pixel_size,
+        seed=seed,
+        simulated_pixel_size=simulated_pixel_size,
+    )
+    return noisy.map_blocks(
+        finalise_image,
+        config=postprocessing,
+        dtype=np.dtype(postprocessing.dtype),
+    )
+
+
+def write_noise_realisations(
+        input_zarr_file: str,
+        output_zarr_file: str,
+        doses: Sequence[float],
+        n_realisations: int,
+        random_seed: Optional[int] = None,
+) -> str:
+    """Generate noise realisations at each dose from a noiseless simulation.
+
+    Results are streamed into an array of shape
+    (n_doses, n_realisations, n_images, ny, nx) in `output_zarr_file`.
+    """
+    expected_store = zarr.convenience.open(input_zarr_file, mode='r')
+    if not expected_store.attrs.get('noiseless', False):
+        raise ValueError(f'{input_zarr_file} does not contain noiseless images')
+    pixel_size = expected_store.attrs['pixel_size']
+    simulated_pixel_size = expected_store.attrs['simulated_pixel_size']
+    postprocessing = PostProcessingConfig(**expected_store.attrs['postprocessing'])
+
+    # entropy is drawn once so every chunk shares the same root seed
+    root_seed = np.random.SeedSequence(random_seed).entropy
+    expected = da.from_zarr(input_zarr_file)
+
+    realisations = da.stack([
+        da.stack([
+            noisy_images(
+                expected,
+                electrons_per_angstrom=dose,
+                pixel_size=pixel_size,
+                postprocessing=postprocessing,
+                seed=(root_seed, dose_idx, realisation),
+                simulated_pixel_size=simulated_pixel_size,
+            )
+            for realisation in range(n_realisations)
+        ])
+        for dose_idx, dose in enumerate(doses)
+    ])
+    da.to_zarr(realisations, output_zarr_file, overwrite=True)
+
+    output_store = zarr.convenience.open(output_zarr_file)
+    output_store.attrs.update({
+        'doses': list(doses),
+        'n_realisations': n_realisations,
+        'random_seed': str(root_seed),
+        'pixel_size': pixel_size,
+    })
+    return output_zarr_file
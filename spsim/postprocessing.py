@@ -0,0 +1,108 @@
+"""
+Post-processing of simulated images prior to storage.
+"""
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import dask.array
+
+    from .data_model import PostProcessingConfig
+
+
+def fourier_crop(image: np.ndarray, output_sidelength: int) -> np.ndarray:
+    """Fourier crop the last two dimensions of an array of square images.
+
+    The mean intensity of each image is preserved.
+    """
+    input_sidelength = image.shape[-1]
+    if output_sidelength == input_sidelength:
+        return image
+    if output_sidelength > input_sidelength:
+        raise ValueError(
+            f'cannot Fourier crop images of sidelength {input_sidelength} '
+            f'to a larger sidelength ({output_sidelength})'
+        )
+    centre = input_sidelength // 2
+    half_width = output_sidelength // 2
+    crop = slice(centre - half_width, centre + half_width)
+
+    ft = np.fft.fftshift(np.fft.fft2(image), axes=(-2, -1))
+    ft = np.fft.ifftshift(ft[..., crop, crop], axes=(-2, -1))
+    cropped = np.real(np.fft.ifft2(ft))
+    return cropped * (output_sidelength / input_sidelength) ** 2
+
+
+def circular_mask(
+        sidelength: int, radius: float, soft_edge_width: float = 0
+) -> np.ndarray:
+    """Circular mask centred on a square image, with an optional cosine edge."""
+    coordinates = np.arange(sidelength) - sidelength // 2
+    distance = np.hypot(*np.meshgrid(coordinates, coordinates, indexing='ij'))
+    if soft_edge_width == 0:
+        return (distance <= radius).astype(np.float32)
+    edge = np.clip((distance - radius) / soft_edge_width, 0, 1)
+    return (0.5 * (1 + np.cos(np.pi * edge))).astype(np.float32)
+
+
+def normalise(image: np.ndarray, background_radius: float) -> np.ndarray:
+    """Normalise the last two dimensions of an array of square images.
+
+    Pixels outside a circle of radius `background_radius` are considered
+    background, normalised images have a background with zero mean and unit
+    standard deviation. Images with a constant background cannot be
+    normalised and raise a ValueError.
+    """
+    background = circular_mask(image.shape[-1], radius=background_radius) == 0
+    background_pixels = image[..., background]
+    if background_pixels.shape[-1] == 0:
+        raise ValueError(
+            f'no background pixels outside a radius of {background_radius}'
+        )
+    mean = np.mean(background_pixels, axis=-1)[..., np.newaxis, np.newaxis]
+    std = np.std(background_pixels, axis=-1)[..., np.newaxis, np.newaxis]
+    if np.any(std == 0):
+        raise ValueError('cannot normalise images with a constant background')
+    return (image - mean) / std
+
+
+def postprocess_image(image: np.ndarray, config: "PostProcessingConfig"):
+    """Apply the post-processing defined in `config` to image(s).
+
+    Operations are applied in the order Fourier cropping, normalisation,
+    masking then conversion to the output dtype.
+    """
+    if config.output_sidelength is not None:
+        image = fourier_crop(image, output_sidelength=config.output_sidelength)
+    return finalise_image(image, config)
+
+
+def finalise_image(image: np.ndarray, config: "PostProcessingConfig"):
+    """Apply normalisation, masking and dtype conversion from `config` to image(s).
+
+    Fourier cropping is not applied.
+    """
+    sidelength = image.shape[-1]
+    if config.normalise:
+        background_radius = config.background_radius or sidelength / 2
+        image = normalise(image, background_radius=background_radius)
+    if config.mask_radius is not None:
+        image = image * circular_mask(
+            sidelength,
+            radius=config.mask_radius,
+            soft_edge_width=config.mask_soft_edge_width,
+        )
+    return image.astype(config.dtype)
+
+
+def postprocess_dask_array(array: "dask.array.Array", config: "PostProcessingConfig"):
+    """Lazily apply the post-processing defined in `config` to a stack of images."""
+    sidelength = config.output_sidelength or array.shape[-1]
+    array = array.rechunk({1: -1, 2: -1})
+    return array.map_blocks(
+        postprocess_image,
+        config=config,
+        chunks=(array.chunks[0], (sidelength,), (sidelength,)),
+        dtype=np.dtype(config.dtype),
+    )
@@ -0,0 +1,183 @@
+"""
+Write simulation results directly as RELION particle stacks and STAR files.
+
+Images are written into preallocated, memory-mapped mrcs shards and one STAR
+row per particle is appended once its image has been written. STAR files are
+therefore valid at any point during a simulation.
+"""
+import fcntl
+from typing import TYPE_CHECKING, List, Tuple
+
+from .parakeet_interface import CONFIG_TEMPLATE
+
+if TYPE_CHECKING:
+    import numpy as np
+
+STAR_VERSION_LINE = '# version 30001'
+
+
+def image_name(idx: int, mrcs_file: str) -> str:
+    """RELION image name for an image in a stack, `idx` is zero-indexed."""
+    return f'{idx + 1:06d}@{mrcs_file}'
+
+
+def shard_location(idx: int, images_per_shard: int) -> Tuple[int, int]:
+    """Shard index and index within that shard for a given image."""
+    return divmod(idx, images_per_shard)
+
+
+def shard_sizes(n_images: int, images_per_shard: int) -> List[int]:
+    """Number of images in each shard for a given number of images."""
+    n_full_shards, remainder = divmod(n_images, images_per_shard)
+    sizes = [images_per_shard] * n_full_shards
+    if remainder > 0:
+        sizes.append(remainder)
+    return sizes
+
+
+def optics_data(image_sidelength: int, pixel_size: float) -> dict:
+    microscope = CONFIG_TEMPLATE['microscope']
+    return {
+        "rlnOpticsGroup": 1,
+        "rlnVoltage": microscope['beam']['energy'],
+        "rlnSphericalAberration": microscope['objective_lens']['c_30'],
+        "rlnAmplitudeContrast": 0.1,
+        "rlnImagePixelSize": pixel_size,
+        "rlnImageSize": image_sidelength,
+        "rlnImageDimensionality": 2,
+    }
+
+
+def particle_data(name: str, eulers: dict, defocus: float) -> dict:
+    """Particle STAR data, `eulers` are RELION eulers and defocus is in microns."""
+    return {
+        "rlnImageName": name,
+        "rlnCoordinateX": 0,
+        "rlnCoordinateY": 0,
+        "rlnAngleRot": eulers['rlnAngleRot'],
+        "rlnAngleTilt": eulers['rlnAngleTilt'],
+        "rlnAnglePsi": eulers['rlnAnglePsi'],
+        "rlnOpticsGroup": 1,
+        "rlnDefocusU": defocus * 1e4,
+        "rlnDefocusV": defocus * 1e4,
+        "rlnDefocusAngle": 0,
+    }
+
+
+PARTICLE_COLUMNS = [
+    "rlnImageName",
+    "rlnCoordinateX",
+    "rlnCoordinateY",
+    "rlnAngleRot",
+    "rlnAngleTilt",
+    "rlnAnglePsi",
+    "rlnOpticsGroup",
+    "rlnDefocusU",
+    "rlnDefocusV",
+    "rlnDefocusAngle",
+]
+
+
+def _format_row(values) -> str:
+    formatted = [
+        f'{value:.6f}' if isinstance(value, float) else str(value)
+        for value in values
+    ]
+    return '\t'.join(formatted) + '\n'
+
+
+def _loop_header(columns) -> str:
+    labels = ''.join(
+        f'_{column} #{idx}\n' for idx, column in enumerate(columns, start=1)
+    )
+    return f'loop_\n{labels}'
+
+
+def write_star_header(star_file: str, optics: dict):
+    """Write the optics block and the header of the particles block."""
+    with open(star_file, 'w') as f:
+        f.write(f'\n{STAR_VERSION_LINE}\n\ndata_optics\n\n')
+        f.write(_loop_header(optics))
+        f.write(_format_row(optics.values()))
+        f.write(f'\n\n{STAR_VERSION_LINE}\n\ndata_particles\n\n')
+        f.write(_loop_header(PARTICLE_COLUMNS))
+    return star_file
+
+
+def append_particle_to_star(
+        star_file: str, particle: dict, skip_if_present: bool = False
+):
+    """Append a single particle row to a STAR file.
+
+    Rows are written in one call under an exclusive lock as many workers
+    append to the same file concurrently. If `skip_if_present` is True the
+    row is not appended when the file already has a row for the same image,
+    returns whether a row was appended.
+    """
+    row = _format_row(particle[column] for column in PARTICLE_COLUMNS)
+    with open(star_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if skip_if_present:
+                f.seek(0)
+                prefix = f'{particle["rlnImageName"]}\t'
+                if any(line.startswith(prefix) for line in f):
+                    return False
+            f.write(row)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return True
+
+
+def count_star_particles(star_file: str) -> int:
+    """Count the particle rows in a STAR file written by `write_star_header`."""
+    n_particles = 0
+    in_particles_block = False
+    with open(star_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == 'data_particles':
+                in_particles_block = True
+            elif (
+                    in_particles_block
+                    and line
+                    and not line.startswith(('_', '#', 'loop_'))
+            ):
+                n_particles += 1
+    return n_particles
+
+
+def create_mrcs_shards(
+        mrcs_files: List[str],
+        sizes: List[int],
+        image_sidelength: int,
+        dtype: str,
+        pixel_size: float,
+):
+    """Preallocate mrcs files into which images can be written in parallel."""
+    import mrcfile
+    import numpy as np
+
+    mrc_mode = mrcfile.utils.mode_from_dtype(np.dtype(dtype))
+    for mrcs_file, n_images in zip(mrcs_files, sizes):
+        shape = (n_images, image_sidelength, image_sidelength)
+        with mrcfile.new_mmap(
+                mrcs_file, shape=shape, mrc_mode=mrc_mode, overwrite=True
+        ) as mrc:
+            mrc.set_image_stack()
+            mrc.voxel_size = pixel_size
+    return mrcs_files
+
+
+def save_image_into_mrcs_shard(image: "np.ndarray", idx: int, mrcs_file: str):
+    """Write an image into a preallocated mrcs shard.
+
+    mrcfile reads a stack containing a single image as 2D so images are
+    written into a 3D view of the data.
+    """
+    import mrcfile
+
+    with mrcfile.mmap(mrcs_file, mode='r+') as mrc:
+        mrc.data.reshape(-1, *image.shape)[idx] = image
+    return True
@@ -1,9 +1,10 @@
 import numpy as np
 from scipy.spatial.transform import Rotation
-from scipy.stats import special_ortho_group
 
 
 def generate_uniform_rotations(n: int, random_seed=None):
+    from scipy.stats import special_ortho_group
+
     return Rotation.from_matrix(special_ortho_group.rvs(
         dim=3, size=n, random_state=random_seed
     ))
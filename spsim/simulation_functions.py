@@ -1,36 +1,83 @@
+"""
+Functions for preparing and running simulations.
+
+gemmi, mrcfile, zarr and dask are imported on first use, this module is
+imported by every dask worker which runs a simulation task.
+"""
+import json
 import os
 import subprocess
+import traceback
 from functools import partial
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Optional
+from time import monotonic, sleep
+from typing import TYPE_CHECKING, Callable, List, Optional
 
-import gemmi
-import mrcfile
 import numpy as np
-import zarr
-from dask import delayed, array as da
-from dask.distributed import fire_and_forget, Client
 
-from .data_model import Simulation, SimulationConfig
-from .gemmi import rotate_structure, structure_to_cif
+from .data_model import (
+    ImageOutcome,
+    PostProcessingConfig,
+    Simulation,
+    SimulationConfig,
+)
+from .frames import FrameSource
 from .parakeet_interface.config import write as write_config
+from .postprocessing import postprocess_image, postprocess_dask_array
+from .relion import (
+    append_particle_to_star,
+    create_mrcs_shards,
+    image_name,
+    optics_data,
+    particle_data,
+    save_image_into_mrcs_shard,
+    shard_sizes,
+    write_star_header,
+)
+from .rotation import rotation_to_relion_eulers
+from .statistics import (
+    create_statistics_directory,
+    histogram_edges,
+    image_statistics,
+    save_image_statistics,
+)
+
+if TYPE_CHECKING:
+    from dask.distributed import Client
+    from scipy.spatial.transform import Rotation
+
+MAX_STDERR_LENGTH = 4000
 
 
 def prepare_simulation(
-        input_directory: Path,
         output_basename: str,
         n_images: int,
         image_sidelength: int,
         defocus_range: tuple[float],
+        input_directory: Optional[Path] = None,
+        topology_file: Optional[Path] = None,
+        trajectory_file: Optional[Path] = None,
         random_seed: int = None,
+        postprocessing: Optional[PostProcessingConfig] = None,
+        output_format: str = 'zarr',
+        cache_directory: Optional[Path] = None,
+        cache_max_size_gb: float = 100,
+        noiseless: bool = False,
 ) -> Simulation:
     input_parameters = SimulationConfig(
         input_directory=input_directory,
+        topology_file=topology_file,
+        trajectory_file=trajectory_file,
         output_basename=output_basename,
         n_images=n_images,
         image_sidelength=image_sidelength,
         defocus_range=defocus_range,
+        postprocessing=postprocessing or PostProcessingConfig(),
+        output_format=output_format,
+        cache_directory=cache_directory,
+        cache_max_size_gb=cache_max_size_gb,
+        noiseless=noiseless,
         random_seed=random_seed
     )
     return Simulation.from_config(
@@ -39,47 +86,117 @@ def prepare_simulation(
 
 
 def create_zarr_store(simulation: Simulation) -> str:
+    import zarr
+
     n_images = len(simulation)
-    nxy = simulation.config.image_sidelength
+    nxy = simulation.config.output_sidelength
     filename = simulation.zarr_filename
     za = zarr.open(
         filename,
         mode='w',
         shape=(n_images, nxy, nxy),
         chunks=(1, nxy, nxy),
-        dtype=np.float16,
+        dtype=simulation.config.effective_postprocessing.dtype,
     )
+    za.attrs.update({
+        'pixel_size': simulation.config.output_pixel_size,
+        'simulated_pixel_size': simulation.config.simulated_pixel_size,
+        'noiseless': simulation.config.noiseless,
+        'postprocessing': simulation.config.postprocessing.dict(),
+    })
     return filename
 
 
+def create_relion_output(simulation: Simulation) -> str:
+    """Preallocate mrcs shards and write the header of the particle STAR file."""
+    config = simulation.config
+    create_mrcs_shards(
+        mrcs_files=simulation.mrcs_filenames,
+        sizes=shard_sizes(len(simulation), config.images_per_shard),
+        image_sidelength=config.output_sidelength,
+        dtype=config.effective_postprocessing.dtype,
+        pixel_size=config.output_pixel_size,
+    )
+    optics = optics_data(
+        image_sidelength=config.output_sidelength,
+        pixel_size=config.output_pixel_size,
+    )
+    return write_star_header(simulation.star_filename, optics=optics)
+
+
+def create_statistics_store(simulation: Simulation) -> str:
+    """Create a store for statistics of each image in the simulation."""
+    config = simulation.config.statistics
+    return create_statistics_directory(
+        directory=simulation.statistics_filename,
+        n_images=len(simulation),
+        n_histogram_bins=config.histogram_bins,
+        histogram_range=simulation.config.histogram_range,
+        thumbnail_sidelength=simulation.thumbnail_sidelength,
+        defoci=[p.defocus for p in simulation.per_image_parameters],
+    )
+
+
 def load_rotate_save(
-        structure_file: str,
+        frame_source: FrameSource,
+        frame_index: int,
         rotation: "Rotation",
         output_filename: str
 ) -> str:
-    """Load a structure, rotate it in memory then save as a cif file.
+    """Load a frame, rotate it in memory then save as a cif file.
 
     This is done in one operation because parallelism requires that operations
     are atomic.
-    Room for IO optimisation here if we move away from gemmi but parallel reads
-    on SCARF are supposed to be well optimised.
+    Frames are read lazily from the frame source, trajectories are
+    memory-mapped where the format allows.
     """
-    structure = gemmi.read_structure(structure_file)
+    from .gemmi import rotate_structure, structure_to_cif
+
+    structure = frame_source.load_frame(frame_index)
     rotate_structure(structure, rotation, center=None)
     structure_to_cif(structure, output_filename)
     return output_filename
 
 
-def simulate_single_image(
-        simulation: Simulation, idx: int, zarr_filename: Optional[str] = None
-) -> np.ndarray:
-    """Generate a single image from a single-particle simulation.
+class ParakeetStageError(RuntimeError):
+    """A parakeet command exited with a non-zero exit code."""
+
+    def __init__(self, stage: str, returncode: int, stderr: str):
+        self.stage = stage
+        self.returncode = returncode
+        self.stderr = stderr
+        super().__init__(
+            f'{stage} failed with exit code {returncode}\n{stderr}'
+        )
+
+
+def run_stage(command: List[str]):
+    """Run a single parakeet command, raising ParakeetStageError on failure.
 
-    Optionally saves image into zarr store
+    Only the end of stderr is kept as parakeet can be very verbose.
     """
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ParakeetStageError(
+            stage=command[0],
+            returncode=result.returncode,
+            stderr=result.stderr[-MAX_STDERR_LENGTH:],
+        )
+    return result
+
+
+def run_parakeet(simulation: Simulation, idx: int) -> np.ndarray:
+    """Run parakeet to simulate a single image, without post-processing.
+
+    For noiseless simulations the expected image intensity per incident
+    electron is returned instead of a noisy, inverted image.
+    """
+    import mrcfile
+
     # get info required for simulation
     image_parameters = simulation.per_image_parameters[idx]
     parakeet_config = simulation.parakeet_config_files[idx]
+    frame_source = simulation.config.frame_source
 
     # do work in a temporary directory (parakeet makes a bunch of files)
     base_directory = Path('.').absolute()
@@ -87,40 +204,67 @@ def simulate_single_image(
     with TemporaryDirectory() as tmp_dir:
         # change into temporary directory
         os.chdir(tmp_dir)
+        try:
+            # rotate structure and save
+            load_rotate_save(
+                frame_source=frame_source,
+                frame_index=image_parameters.frame_index,
+                rotation=image_parameters.rotation,
+                output_filename=image_parameters.rotated_structure_filename
+            )
 
-        # rotate structure and save
-        load_rotate_save(
-            structure_file=str(image_parameters.input_structure),
-            rotation=image_parameters.rotation,
-            output_filename=image_parameters.rotated_structure_filename
-        )
+            # write parakeet config file
+            write_config(parakeet_config, 'parakeet_config.yaml')
 
-        # write parakeet config file
-        write_config(parakeet_config, 'parakeet_config.yaml')
+            # run parakeet
+            run_stage(['parakeet.sample.new', '-c', 'parakeet_config.yaml'])
+            run_stage(['parakeet.simulate.exit_wave', '-c', 'parakeet_config.yaml'])
+            run_stage(['parakeet.simulate.optics', '-c', 'parakeet_config.yaml'])
 
-        # run parakeet
-        subprocess.run(
-            ['parakeet.sample.new', '-c', 'parakeet_config.yaml']
-        )
-        subprocess.run(
-            ['parakeet.simulate.exit_wave', '-c', 'parakeet_config.yaml']
-        )
-        subprocess.run(
-            ['parakeet.simulate.optics', '-c', 'parakeet_config.yaml']
-        )
-        subprocess.run(
-            ['parakeet.simulate.image', '-c', 'parakeet_config.yaml']
-        )
-        subprocess.run(
-            ['parakeet.export', 'image.h5', '-o', 'image.mrc']
-        )
+            if simulation.config.noiseless:
+                # expected image is the output of the optics simulation
+                run_stage(['parakeet.export', 'optics.h5', '-o', 'optics.mrc'])
+                with mrcfile.open('optics.mrc') as mrc:
+                    image = np.squeeze(mrc.data).copy()
+            else:
+                run_stage(['parakeet.simulate.image', '-c', 'parakeet_config.yaml'])
+                run_stage(['parakeet.export', 'image.h5', '-o', 'image.mrc'])
+
+                # load image file and invert
+                with mrcfile.open('image.mrc') as mrc:
+                    image = np.squeeze(mrc.data) * -1
+        finally:
+            # change back to base directory, also if a stage failed
+            os.chdir(base_directory)
+    return image
+
+
+def simulate_single_image(
+        simulation: Simulation,
+        idx: int,
+        zarr_filename: Optional[str] = None,
+        postprocess: bool = True,
+) -> np.ndarray:
+    """Generate a single image from a single-particle simulation.
+
+    The image cache is consulted before running parakeet if the simulation
+    has one. Images are post-processed according to the simulation config
+    unless `postprocess` is False. Optionally saves image into zarr store.
+    """
+    image_cache = simulation.image_cache
+    image = None
+    if image_cache is not None:
+        cache_key = simulation.image_cache_key(idx)
+        image = image_cache.get(cache_key)
 
-        # load image file and invert
-        with mrcfile.open('image.mrc') as mrc:
-            image = np.squeeze(mrc.data) * -1
+    if image is None:
+        image = run_parakeet(simulation=simulation, idx=idx)
+        if image_cache is not None:
+            image_cache.put(cache_key, image)
 
-    # change back to base directory
-    os.chdir(base_directory)
+    # crop, normalise, mask and cast before saving
+    if postprocess:
+        image = postprocess_image(image, simulation.config.effective_postprocessing)
 
     # optionally save image into zarr store
     if zarr_filename is not None:
@@ -131,46 +275,266 @@ def simulate_single_image(
 
 
 def save_image_into_zarr_store(image, idx, zarr_filename):
+    import zarr
+
     zs = zarr.convenience.open(zarr_filename)
     zs[idx, ...] = image
     return True
 
 
+def save_image_into_relion_output(
+        simulation: Simulation, image, idx, retry: bool = False
+):
+    """Write an image into its mrcs shard then append its particle STAR row.
+
+    The STAR row is only written once the image is on disk so that every
+    particle in the STAR file can be read. When retrying an image the row is
+    not appended again if an earlier attempt already wrote it.
+    """
+    mrcs_file, shard_idx = simulation.mrcs_location(idx)
+    save_image_into_mrcs_shard(image=image, idx=shard_idx, mrcs_file=mrcs_file)
+
+    image_parameters = simulation.per_image_parameters[idx]
+    particle = particle_data(
+        name=image_name(shard_idx, mrcs_file),
+        eulers=rotation_to_relion_eulers(image_parameters.rotation),
+        defocus=image_parameters.defocus,
+    )
+    append_particle_to_star(
+        simulation.star_filename, particle=particle, skip_if_present=retry
+    )
+    return True
+
+
+def save_image(simulation: Simulation, image, idx, retry: bool = False):
+    """Save an image in the output format defined by the simulation config
+
+    Statistics for the image are computed and saved before the image itself.
+    `retry` marks a repeated attempt at an image which may already have been
+    partially saved.
+    """
+    config = simulation.config.statistics
+    if config is not None:
+        statistics = image_statistics(
+            image,
+            histogram_edges=histogram_edges(
+                config.histogram_bins, simulation.config.histogram_range
+            ),
+            thumbnail_sidelength=simulation.thumbnail_sidelength,
+        )
+        save_image_statistics(
+            statistics, idx=idx, directory=simulation.statistics_filename
+        )
+    if simulation.config.output_format == 'relion':
+        return save_image_into_relion_output(
+            simulation=simulation, image=image, idx=idx, retry=retry
+        )
+    return save_image_into_zarr_store(
+        image=image, idx=idx, zarr_filename=simulation.zarr_filename
+    )
+
+
+def simulate_image_block(simulation: Simulation, block_info=None) -> np.ndarray:
+    """Simulate the images in one chunk of a simulation dask array."""
+    start, stop = block_info[None]['array-location'][0]
+    images = [
+        simulate_single_image(simulation, idx, postprocess=False)
+        for idx in range(start, stop)
+    ]
+    return np.stack(images).astype(np.float32)
+
+
 def simulation_as_dask_array(
-        simulation: Simulation
+        simulation: Simulation,
+        images_per_chunk: int = 1
 ):
-    """Provide a dask array around results of a simulation"""
-    # make lazy-version of the simulate_image function
-    lazy_simulate_single_image = delayed(simulate_single_image)
+    """Provide a dask array around results of a simulation.
+
+    The array is built from a single blockwise layer so the size of the task
+    graph does not grow with the number of images. The simulation is
+    referenced once in the graph rather than embedded in every task.
+    Post-processing is applied lazily to the stack of simulated images.
+    """
+    from dask import delayed, array as da
+    from dask.array.core import normalize_chunks
 
-    # precompute image shape
     nx = simulation.config.image_sidelength
-    image_shape = (nx, nx)
+    shape = (len(simulation), nx, nx)
+    chunks = normalize_chunks((images_per_chunk, nx, nx), shape=shape)
 
-    # lazy array calculation
-    delayed_images = [
-        lazy_simulate_single_image(simulation, idx)
-        for idx
-        in range(len(simulation))
-    ]
+    particle_stack = da.map_blocks(
+        simulate_image_block,
+        delayed(simulation, traverse=False),
+        chunks=chunks,
+        dtype=np.float32,
+        meta=np.empty((0, 0, 0), dtype=np.float32),
+    )
+    return postprocess_dask_array(
+        particle_stack, simulation.config.effective_postprocessing
+    )
 
-    dask_arrays = [
-        da.from_delayed(delayed_image, shape=image_shape, dtype=np.float32)
-        for delayed_image in delayed_images
-    ]
 
-    # create stack from lazy images
-    particle_stack = da.stack(dask_arrays, axis=0)
-    return particle_stack
+def classify_failure(exception: BaseException) -> str:
+    """Classify an exception raised while simulating an image.
+
+    Failures of parakeet stages and of the operating system (e.g. GPU out of
+    memory, a node hiccup, a full scratch disk) are worth retrying elsewhere,
+    anything else is a problem with the simulation itself.
+    """
+    if isinstance(exception, (ParakeetStageError, OSError, MemoryError)):
+        return 'retryable'
+    return 'fatal'
+
+
+def _current_worker() -> Optional[str]:
+    from dask.distributed import get_worker
+
+    try:
+        return get_worker().address
+    except ValueError:  # not running on a dask worker
+        return None
+
+
+def simulate_image_with_outcome(
+        simulation: Simulation, idx: int, attempt: int = 1
+) -> ImageOutcome:
+    """Simulate and save a single image, reporting the outcome rather than raising."""
+    worker = _current_worker()
+    try:
+        simulation.simulate_image(idx, retry=attempt > 1)
+    except Exception as e:
+        return ImageOutcome(
+            idx=idx,
+            status=classify_failure(e),
+            attempt=attempt,
+            worker=worker,
+            stage=getattr(e, 'stage', None),
+            returncode=getattr(e, 'returncode', None),
+            error=getattr(e, 'stderr', None) or traceback.format_exc()[-MAX_STDERR_LENGTH:],
+        )
+    return ImageOutcome(idx=idx, status='success', attempt=attempt, worker=worker)
+
+
+def _identity(value):
+    return value
+
+
+def write_failure_manifest(simulation: Simulation, failures: List[ImageOutcome]):
+    """Write images which could not be simulated, and why, to a json file."""
+    manifest = {
+        'n_images': len(simulation),
+        'n_failed': len(failures),
+        'failures': [
+            json.loads(outcome.json())
+            for outcome in sorted(failures, key=lambda outcome: outcome.idx)
+        ],
+    }
+    with open(simulation.failure_manifest_filename, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return simulation.failure_manifest_filename
 
 
 def execute(
         simulation: Simulation,
-        client: Client
-):
-    n_images = len(simulation)
-    simulation.create_zarr_store()
-    for idx in range(n_images):
-        future = client.submit(simulation.simulate_image, idx)
-        fire_and_forget(future)
-    return
+        client: "Client",
+        max_retries: int = 3,
+        retry_delay: float = 10,
+        progress: Optional[Callable[[int, int], None]] = None,
+) -> List[ImageOutcome]:
+    """Simulate all images on a dask cluster, retrying failures.
+
+    The simulation is added to the task graph once, as a task which returns
+    it, and shared by all image tasks. Unlike scattered data it does not
+    need workers to exist yet and is recomputed if the workers holding it go
+    away (e.g. SLURM workers reaching their lifetime). Retryable failures
+    are resubmitted up to `max_retries` times after an exponential backoff
+    starting at `retry_delay` seconds, preferring a different worker. Images
+    which fail for good are recorded in the failure manifest as soon as they
+    fail. `progress` is called with the number of succeeded and failed images
+    whenever an image finishes.
+
+    Returns the final outcome for each image.
+    """
+    from dask.distributed import TimeoutError, wait
+    from distributed.client import FuturesCancelledError
+
+    simulation.create_output()
+    simulation_future = client.submit(_identity, simulation, pure=False)
+
+    def submit(idx: int, attempt: int, avoid_worker: Optional[str] = None):
+        restrictions = {}
+        if avoid_worker is not None:
+            workers = [
+                worker for worker in client.scheduler_info()['workers']
+                if worker != avoid_worker
+            ]
+            if workers:
+                restrictions = {'workers': workers, 'allow_other_workers': True}
+        future = client.submit(
+            simulate_image_with_outcome,
+            simulation_future,
+            idx,
+            attempt,
+            pure=False,
+            **restrictions,
+        )
+        future_attempts[future] = (idx, attempt)
+        return future
+
+    future_attempts = {}
+    running = {submit(idx, attempt=1) for idx in range(len(simulation))}
+    retries = []  # (time at which to retry, idx, attempt, worker to avoid)
+    outcomes, failures = {}, []
+
+    while running or retries:
+        # resubmit retries which have finished backing off
+        now = monotonic()
+        due = [retry for retry in retries if retry[0] <= now]
+        retries = [retry for retry in retries if retry[0] > now]
+        for _, idx, attempt, avoid_worker in due:
+            running.add(submit(idx, attempt, avoid_worker))
+
+        timeout = min(retry[0] for retry in retries) - now if retries else None
+        if not running:
+            sleep(timeout)
+            continue
+        try:
+            done, running = wait(running, timeout=timeout, return_when='FIRST_COMPLETED')
+        except TimeoutError:
+            continue
+        except FuturesCancelledError:  # raised rather than returned by wait
+            done = {future for future in running if future.status != 'pending'}
+            running = running - done
+
+        for future in done:
+            idx, attempt = future_attempts.pop(future)
+            if future.status == 'finished':
+                outcome = future.result()
+            else:  # the task failed or was cancelled, e.g. its worker died
+                error = f'task {future.status}'
+                try:
+                    future.result()
+                except Exception as e:
+                    error = repr(e)
+                outcome = ImageOutcome(
+                    idx=idx,
+                    status='retryable',
+                    attempt=attempt,
+                    error=error,
+                )
+            future.release()
+
+            if outcome.status == 'retryable' and attempt <= max_retries:
+                backoff = retry_delay * 2 ** (attempt - 1)
+                retries.append((monotonic() + backoff, idx, attempt + 1, outcome.worker))
+                continue
+
+            outcomes[idx] = outcome
+            if outcome.status != 'success':
+                failures.append(outcome)
+                write_failure_manifest(simulation, failures)
+            if progress is not None:
+                progress(len(outcomes) - len(failures), len(failures))
+
+    write_failure_manifest(simulation, failures)
+    return [outcomes[idx] for idx in range(len(simulation))]
@@ -0,0 +1,280 @@
+"""
+Summary statistics computed for each image as it is simulated.
+
+Workers compute statistics for each image before it is stored. They record
+moments (count, sum, sum of squares, min, max), a histogram over fixed bins
+and a small Fourier cropped thumbnail. All of these are partial aggregates
+which can be merged by summation (or min/max), so dataset-level statistics
+and QC averages are produced without reading full images.
+
+Statistics are stored as fixed-size records appended to one file per
+process, so each image costs a single write and the number of files does not
+grow with the number of images.
+"""
+import json
+import os
+import socket
+from pathlib import Path
+from typing import Dict, Iterator, Tuple
+from uuid import uuid4
+
+import numpy as np
+
+from .postprocessing import fourier_crop
+
+N_MOMENTS = 5  # count, sum, sum of squares, min, max
+RECORDS_PER_BLOCK = 4096
+
+# records written by this process are appended to a file of their own
+_process_id = f'{socket.gethostname()}_{uuid4().hex}'
+
+
+def histogram_edges(n_bins: int, histogram_range: Tuple[float, float]) -> np.ndarray:
+    return np.linspace(*histogram_range, num=n_bins + 1)
+
+
+def image_statistics(
+        image: np.ndarray,
+        histogram_edges: np.ndarray,
+        thumbnail_sidelength: int,
+) -> Dict[str, np.ndarray]:
+    """Mergeable summary statistics for a single image.
+
+    Histograms have an extra bin at each end for values outside the edges.
+    """
+    image = np.asarray(image, dtype=np.float64)
+    moments = np.array([
+        image.size, image.sum(), np.square(image).sum(), image.min(), image.max()
+    ])
+    bin_idx = np.searchsorted(histogram_edges, image.ravel(), side='right')
+    histogram = np.bincount(bin_idx, minlength=len(histogram_edges) + 1)
+    thumbnail = fourier_crop(image, output_sidelength=thumbnail_sidelength)
+    return {
+        'moments': moments,
+        'histogram': histogram,
+        'thumbnail': thumbnail.astype(np.float32),
+    }
+
+
+def record_dtype(n_histogram_bins: int, thumbnail_sidelength: int) -> np.dtype:
+    """dtype of the record stored for each image"""
+    return np.dtype([
+        ('idx', '<i8'),
+        ('moments', '<f8', (N_MOMENTS,)),
+        ('histogram', '<i4', (n_histogram_bins + 2,)),
+        ('thumbnail', '<f4', (thumbnail_sidelength, thumbnail_sidelength)),
+    ])
+
+
+def create_statistics_directory(
+        directory: str,
+        n_images: int,
+        n_histogram_bins: int,
+        histogram_range: Tuple[float, float],
+        thumbnail_sidelength: int,
+        defoci: np.ndarray,
+) -> str:
+    """Create a directory into which workers append statistics records."""
+    directory = Path(directory)
+    (directory / 'records').mkdir(parents=True, exist_ok=True)
+    for records_file in (directory / 'records').glob('*.bin'):
+        records_file.unlink()
+    np.save(directory / 'defocus.npy', np.asarray(defoci, dtype=np.float64))
+    metadata = {
+        'n_images': n_images,
+        'n_histogram_bins': n_histogram_bins,
+        'histogram_edges': histogram_edges(n_histogram_bins, histogram_range).tolist(),
+        'thumbnail_sidelength': thumbnail_sidelength,
+    }
+    (directory / 'metadata.json').write_text(json.dumps(metadata))
+    return str(directory)
+
+
+def save_image_statistics(statistics: Dict[str, np.ndarray], idx: int, directory: str):
+    """Append the statistics of a single image to this process's records file.
+
+    A partially written record is removed if the write fails so later records
+    stay aligned.
+    """
+    thumbnail = statistics['thumbnail']
+    record = np.zeros(1, dtype=record_dtype(
+        n_histogram_bins=len(statistics['histogram']) - 2,
+        thumbnail_sidelength=thumbnail.shape[-1],
+    ))
+    record['idx'] = idx
+    for name, value in statistics.items():
+        record[name] = value
+
+    records_file = Path(directory) / 'records' / f'{_process_id}.bin'
+    with open(records_file, 'ab') as f:
+        position = f.tell()
+        try:
+            f.write(record.tobytes())
+            f.flush()
+        except BaseException:
+            f.truncate(position)
+            raise
+    return True
+
+
+def _read_records(directory: Path, dtype: np.dtype) -> Iterator[np.ndarray]:
+    """Memory-map the complete records in each records file."""
+    for records_file in sorted((directory / 'records').glob('*.bin')):
+        n_records = os.path.getsize(records_file) // dtype.itemsize
+        if n_records > 0:
+            yield np.memmap(records_file, dtype=dtype, mode='r', shape=(n_records,))
+
+
+def merge_moments(moments: np.ndarray) -> Dict[str, float]:
+    """Merge moments from many images into dataset-level statistics."""
+    count = moments[:, 0].sum()
+    mean = moments[:, 1].sum() / count
+    variance = moments[:, 2].sum() / count - mean ** 2
+    return {
+        'mean': float(mean),
+        'std': float(np.sqrt(max(variance, 0))),
+        'min': float(moments[:, 3].min()),
+        'max': float(moments[:, 4].max()),
+    }
+
+
+def per_image_mean_and_std(moments: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    count = moments[:, 0]
+    mean = moments[:, 1] / count
+    std = np.sqrt(np.clip(moments[:, 2] / count - mean ** 2, 0, None))
+    return mean, std
+
+
+def summarise_statistics(directory: str, n_defocus_bins: int = 5) -> dict:
+    """Dataset-level statistics from the statistics of completed images.
+
+    Records are read in blocks, one record is used per image if an image was
+    retried. Averages of thumbnails are computed for equally sized defocus bins.
+    """
+    directory = Path(directory)
+    metadata = json.loads((directory / 'metadata.json').read_text())
+    dtype = record_dtype(
+        metadata['n_histogram_bins'], metadata['thumbnail_sidelength']
+    )
+    records = list(_read_records(directory, dtype))
+    if len(records) == 0:
+        raise ValueError(f'no images have statistics in {directory}')
+
+    # first record for each image, as a mask per records file
+    indices = np.concatenate([r['idx'] for r in records])
+    _, first = np.unique(indices, return_index=True)
+    keep = np.zeros(len(indices), dtype=bool)
+    keep[first] = True
+    offsets = np.cumsum([0] + [len(r) for r in records])
+    keep_per_file = [keep[start:stop] for start, stop in zip(offsets, offsets[1:])]
+
+    completed = indices[keep]
+    moments = np.concatenate([r['moments'][k] for r, k in zip(records, keep_per_file)])
+    defoci = np.load(directory / 'defocus.npy')
+    defocus_edges = np.linspace(
+        defoci[completed].min(), defoci[completed].max(), num=n_defocus_bins + 1
+    )
+    defocus_bins = np.clip(
+        np.searchsorted(defocus_edges, defoci, side='right') - 1, 0, n_defocus_bins - 1
+    )
+
+    histogram = np.zeros(dtype['histogram'].shape, dtype=np.int64)
+    thumbnail_sums = np.zeros(
+        (n_defocus_bins, *dtype['thumbnail'].shape), dtype=np.float64
+    )
+    for file_records, file_keep in zip(records, keep_per_file):
+        for start in range(0, len(file_records), RECORDS_PER_BLOCK):
+            block_slice = slice(start, start + RECORDS_PER_BLOCK)
+            block = file_records[block_slice][file_keep[block_slice]]
+            histogram += block['histogram'].sum(axis=0)
+            block_bins = defocus_bins[block['idx']]
+            for bin_idx in np.unique(block_bins):
+                in_bin = block['thumbnail'][block_bins == bin_idx]
+                thumbnail_sums[bin_idx] += in_bin.sum(axis=0)
+    bin_counts = np.bincount(defocus_bins[completed], minlength=n_defocus_bins)
+    defocus_averages = thumbnail_sums / np.maximum(bin_counts, 1)[:, None, None]
+
+    image_means, image_stds = per_image_mean_and_std(moments)
+    return {
+        'n_images': int(metadata['n_images']),
+        'n_images_completed': int(len(completed)),
+        'intensity': merge_moments(moments),
+        'image_mean_percentiles': np.percentile(image_means, [1, 50, 99]).tolist(),
+        'image_std_percentiles': np.percentile(image_stds, [1, 50, 99]).tolist(),
+        'histogram_edges': metadata['histogram_edges'],
+        'histogram': histogram.tolist(),
+        'defocus_bin_edges': defocus_edges.tolist(),
+        'defocus_bin_counts': bin_counts.tolist(),
+        'defocus_averages': defocus_averages,
+        'image_means': image_means,
+        'image_stds': image_stds,
+        'defoci': defoci[completed],
+    }
+
+
+def plot_statistics(summary: dict, filename: str):
+    """Plot QC figures from a summary produced by `summarise_statistics`."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    averages = summary['defocus_averages']
+    n_columns = max(3, len(averages))
+    fig, axes = plt.subplots(2, n_columns, figsize=(3 * n_columns, 6))
+
+    edges = np.asarray(summary['histogram_edges'])
+    axes[0, 0].stairs(summary['histogram'][1:-1], edges)
+    axes[0, 0].set(title='intensity histogram', xlabel='intensity', yscale='log')
+    axes[0, 1].scatter(summary['defoci'], summary['image_means'], s=1)
+    axes[0, 1].set(title='image mean', xlabel='defocus (um)')
+    axes[0, 2].scatter(summary['defoci'], summary['image_stds'], s=1)
+    axes[0, 2].set(title='image std', xlabel='defocus (um)')
+    for ax in axes[0, 3:]:
+        ax.axis('off')
+
+    defocus_edges = summary['defocus_bin_edges']
+    for idx, ax in enumerate(axes[1]):
+        ax.axis('off')
+        if idx < len(averages):
+            ax.imshow(averages[idx], cmap='gray')
+            ax.set_title(
+                f'{defocus_edges[idx]:.2f}-{defocus_edges[idx + 1]:.2f} um '
+                f'(n={summary["defocus_bin_counts"][idx]})'
+            )
+    fig.tight_layout()
+    fig.savefig(filename)
+    plt.close(fig)
+    return filename
+
+
+def write_statistics_report(
+        statistics_directory: str, output_basename: str, n_defocus_bins: int = 5
+) -> dict:
+    """Write dataset statistics (json), defocus averages (mrcs) and QC plots (png).
+
+    Plots are only written if matplotlib is installed. Returns a dict mapping
+    each output to its filename.
+    """
+    import mrcfile
+
+    summary = summarise_statistics(
+        statistics_directory, n_defocus_bins=n_defocus_bins
+    )
+    outputs = {
+        'statistics': f'{output_basename}_statistics.json',
+        'defocus_averages': f'{output_basename}_defocus_averages.mrcs',
+    }
+    array_keys = ('defocus_averages', 'image_means', 'image_stds', 'defoci')
+    with open(outputs['statistics'], 'w') as f:
+        json.dump(
+            {k: v for k, v in summary.items() if k not in array_keys}, f, indent=2
+        )
+    with mrcfile.new(outputs['defocus_averages'], overwrite=True) as mrc:
+        mrc.set_data(summary['defocus_averages'].astype(np.float32))
+        mrc.set_image_stack()
+
+    try:
+        outputs['plots'] = plot_statistics(summary, f'{output_basename}_qc.png')
+    except ImportError:
+        pass
+    return outputs
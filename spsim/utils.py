@@ -3,13 +3,10 @@ import os
 from copy import deepcopy
 from pathlib import Path
 
-import mrcfile
-import starfile
-import pandas as pd
 import yaml
-import zarr
 
 from .parakeet_interface import CONFIG_TEMPLATE
+from .relion import image_name, optics_data, particle_data
 
 
 def files_in_directory(directory):
@@ -50,6 +47,9 @@ def generate_parakeet_config(
 
 
 def zarr2mrcs(zarr_file, mrcs_file):
+    import mrcfile
+    import zarr
+
     za = zarr.convenience.open(zarr_file)
     mrc = mrcfile.new_mmap(mrcs_file, shape=za.shape, mrc_mode=2)
     for idx in range(za.shape[0]):
@@ -59,51 +59,31 @@ def zarr2mrcs(zarr_file, mrcs_file):
 
 
 def json2star(json_file, star_file):
+    import pandas as pd
+    import starfile
+
     with open(json_file, 'r') as f:
         simulation_data = json.load(f)
 
-    optics_df_dict = {
-        "rlnOpticsGroup": [1],
-        "rlnVoltage": [300],
-        "rlnSphericalAberration": [2.7],
-        "rlnAmplitudeContrast": [0.1],
-        "rlnImagePixelSize": [1.0],
-        "rlnImageSize": [simulation_data['config']['image_sidelength']],
-        "rlnImageDimensionality": [2],
-    }
-    optics_df = pd.DataFrame.from_dict(optics_df_dict)
-
-    particle_df_dict = {
-        "rlnImageName": [
-            f"{idx:06d}@{simulation_data['config']['output_basename']}.mrcs"
-            for idx, _ in enumerate(simulation_data['per_image_parameters'])
-        ],
-        "rlnCoordinateX": 0,
-        "rlnCoordinateY": 0,
-        "rlnAngleRot": [
-            parameters['rotation']['rlnAngleRot']
-            for parameters in simulation_data['per_image_parameters']
-        ],
-        "rlnAngleTilt": [
-            parameters['rotation']['rlnAngleTilt']
-            for parameters in simulation_data['per_image_parameters']
-        ],
-        "rlnAnglePsi": [
-            parameters['rotation']['rlnAnglePsi']
-            for parameters in simulation_data['per_image_parameters']
-        ],
-        "rlnOpticsGroup": 1,
-        "rlnDefocusU": [
-            parameters['defocus'] * 1e5
-            for parameters in simulation_data['per_image_parameters']
-        ],
-        "rlnDefocusV": [
-            parameters['defocus'] * 1e5
-            for parameters in simulation_data['per_image_parameters']
-        ],
-        "rlnDefocusAngle": 0,
-    }
-    particle_df = pd.DataFrame.from_dict(particle_df_dict)
+    # account for Fourier cropping during post-processing
+    image_sidelength = simulation_data['config']['image_sidelength']
+    postprocessing = simulation_data['config'].get('postprocessing') or {}
+    output_sidelength = postprocessing.get('output_sidelength') or image_sidelength
+    pixel_size = CONFIG_TEMPLATE['microscope']['detector']['pixel_size']
+    output_pixel_size = pixel_size * image_sidelength / output_sidelength
+
+    optics_df = pd.DataFrame([optics_data(output_sidelength, output_pixel_size)])
+
+    mrcs_file = f"{simulation_data['config']['output_basename']}.mrcs"
+    particles = [
+        particle_data(
+            name=image_name(idx, mrcs_file),
+            eulers=parameters['rotation'],
+            defocus=parameters['defocus'],
+        )
+        for idx, parameters in enumerate(simulation_data['per_image_parameters'])
+    ]
+    particle_df = pd.DataFrame(particles)
     starfile.write(
         data={'optics': optics_df, 'particles': particle_df},
         filename=star_file
@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from spsim.cache import ImageCache, image_cache_key
+from spsim.parakeet_interface import CONFIG_TEMPLATE
+
+
+def test_image_cache_key():
+    rotation = Rotation.from_euler('ZYZ', (10, 20, 30), degrees=True)
+    key = image_cache_key('frame', rotation, 1.5, CONFIG_TEMPLATE)
+
+    # equivalent quaternion and different structure filename give same key
+    equivalent_rotation = Rotation.from_quat(-rotation.as_quat())
+    config = {**CONFIG_TEMPLATE}
+    coords = {**config['sample']['coords'], 'filename': 'other.cif'}
+    config['sample'] = {**config['sample'], 'coords': coords}
+    assert image_cache_key('frame', equivalent_rotation, 1.5, config) == key
+
+    assert image_cache_key('frame', rotation, 2.5, CONFIG_TEMPLATE) != key
+    assert image_cache_key('other', rotation, 1.5, CONFIG_TEMPLATE) != key
+
+
+def test_image_cache_hits_and_misses(tmp_path):
+    cache = ImageCache(tmp_path, max_size_bytes=10 ** 6)
+    image = np.ones((8, 8), dtype=np.float32)
+    assert cache.get('abcd') is None
+    cache.put('abcd', image)
+    assert np.array_equal(cache.get('abcd'), image)
+
+    stats = cache.stats()
+    assert (stats.hits, stats.misses) == (1, 1)
+    assert stats.hit_rate == 0.5
+
+
+def test_image_cache_eviction(tmp_path):
+    image = np.ones((16, 16), dtype=np.float32)
+    cache = ImageCache(tmp_path, max_size_bytes=10 ** 6)
+    cache.put('aa01', image)
+    file_size = cache.path('aa01').stat().st_size
+
+    cache.max_size_bytes = 2.5 * file_size
+    cache.put('aa02', image)
+    assert cache.size() == 2 * file_size
+
+    # aa01 was used more recently than aa02
+    os.utime(cache.path('aa02'), (1, 1))
+    os.utime(cache.path('aa01'), (2, 2))
+    cache.put('aa03', image)
+    stored = sorted(path.stem for path in cache.images_directory.glob('*/*.npy'))
+    assert stored == ['aa01', 'aa03']
+    assert cache.size() == 2 * file_size
@@ -1,5 +1,7 @@
 import json
 
+import pytest
+from pydantic import ValidationError
 from scipy.spatial.transform import Rotation
 
 from spsim.data_model import SimulationConfig, SingleImageParameters, Simulation
@@ -18,9 +20,20 @@ def test_simulation_config():
     return input_parameters
 
 
+def test_simulation_config_empty_input_directory(tmp_path):
+    with pytest.raises(ValidationError):
+        SimulationConfig(
+            input_directory=tmp_path,
+            output_basename='test',
+            n_images=1,
+            image_sidelength=512,
+            defocus_range=(0.5, 4.5)
+        )
+
+
 def test_image_parameters_instantiation():
     image_parameters = SingleImageParameters(
-        input_structure=TEST_DATA_DIR / 'trajectory' / '6vxx.pdb',
+        frame_index=0,
         rotation=Rotation.random(num=1),
         defocus=1.5
     )
@@ -46,6 +59,12 @@ def test_simulation_from_input_parameters():
     return simulation
 
 
+def test_rotated_structure_filename_from_frame_name():
+    simulation = test_simulation_from_input_parameters()
+    image_parameters = simulation.per_image_parameters[0]
+    assert image_parameters.rotated_structure_filename.startswith('6vxx_')
+
+
 def test_simulation_json_encoding():
     simulation = test_simulation_from_input_parameters()
     encoded = simulation.json()
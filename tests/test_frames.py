@@ -0,0 +1,41 @@
+import numpy as np
+
+from spsim.frames import DCDFile, StructureFileFrameSource
+from .constants import TEST_DATA_DIR
+
+
+def write_dcd(filename, coordinates: np.ndarray):
+    """Write a minimal CHARMM DCD file from an (n_frames, n_atoms, 3) array."""
+    n_frames, n_atoms, _ = coordinates.shape
+
+    def record(data: bytes):
+        marker = np.array([len(data)], dtype='<i4').tobytes()
+        return marker + data + marker
+
+    control = np.zeros(20, dtype='<i4')
+    control[0] = n_frames
+    control[19] = 24
+    with open(filename, 'wb') as f:
+        f.write(record(b'CORD' + control.tobytes()))
+        f.write(record(np.array([1], dtype='<i4').tobytes() + b' ' * 80))
+        f.write(record(np.array([n_atoms], dtype='<i4').tobytes()))
+        for frame in coordinates.astype('<f4'):
+            for dim in range(3):
+                f.write(record(frame[:, dim].tobytes()))
+
+
+def test_structure_file_frame_source():
+    frame_source = StructureFileFrameSource(TEST_DATA_DIR / 'trajectory')
+    assert len(frame_source) == 1
+    assert frame_source.frame_name(0) == '6vxx'
+
+
+def test_dcd_file(tmp_path):
+    coordinates = np.random.default_rng(0).normal(size=(5, 10, 3))
+    dcd_file = tmp_path / 'trajectory.dcd'
+    write_dcd(dcd_file, coordinates)
+
+    dcd = DCDFile(dcd_file)
+    assert dcd.n_atoms == 10
+    assert len(dcd) == 5
+    assert np.allclose(dcd.coordinates(3), coordinates[3], atol=1e-6)
@@ -0,0 +1,45 @@
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = (
+    'dask', 'dask.distributed', 'dask_jobqueue', 'gemmi', 'mrcfile', 'zarr',
+    'pandas', 'starfile', 'scipy', 'pydantic',
+)
+
+# (module, import time budget in seconds, heavy modules which may be imported)
+ENTRY_POINTS = [
+    ('spsim', 0.5, ()),
+    ('spsim.cli', 0.5, ()),
+    ('spsim.utils', 0.5, ()),
+    ('spsim.simulation_functions', 2.0, ('scipy', 'pydantic')),
+]
+
+MEASURE_IMPORT = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(','.join(name for name in {heavy_modules!r} if name in sys.modules))
+'''
+
+
+def measure_import(module):
+    code = MEASURE_IMPORT.format(module=module, heavy_modules=HEAVY_MODULES)
+    result = subprocess.run(
+        [sys.executable, '-c', code], capture_output=True, text=True, check=True
+    )
+    import_time, imported = result.stdout.splitlines()
+    return float(import_time), set(filter(None, imported.split(',')))
+
+
+@pytest.mark.parametrize('module, budget, allowed', ENTRY_POINTS)
+def test_import_time(module, budget, allowed):
+    # best of three to reduce sensitivity to a busy machine
+    measurements = [measure_import(module) for _ in range(3)]
+    import_time = min(import_time for import_time, _ in measurements)
+    _, imported = measurements[0]
+
+    assert imported <= set(allowed)
+    assert import_time < budget
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from spsim.data_model import PostProcessingConfig
+from spsim.postprocessing import fourier_crop, normalise, postprocess_image
+
+
+def test_fourier_crop_shape_and_mean():
+    image = np.random.default_rng(0).normal(loc=5, size=(64, 64))
+    cropped = fourier_crop(image, output_sidelength=32)
+    assert cropped.shape == (32, 32)
+    assert np.allclose(cropped.mean(), image.mean())
+
+
+def test_fourier_crop_stack():
+    images = np.zeros((3, 64, 64))
+    assert fourier_crop(images, output_sidelength=16).shape == (3, 16, 16)
+
+
+def test_fourier_crop_larger_sidelength():
+    with pytest.raises(ValueError):
+        fourier_crop(np.zeros((32, 32)), output_sidelength=64)
+
+
+def test_normalise():
+    image = np.random.default_rng(0).normal(loc=5, scale=3, size=(64, 64))
+    normalised = normalise(image, background_radius=16)
+    background = np.hypot(*np.mgrid[-32:32, -32:32]) > 16
+    assert np.isclose(normalised[background].mean(), 0)
+    assert np.isclose(normalised[background].std(), 1)
+
+
+def test_postprocess_image():
+    config = PostProcessingConfig(
+        output_sidelength=32, normalise=True, mask_radius=12, dtype='float32'
+    )
+    image = np.random.default_rng(0).normal(size=(64, 64))
+    processed = postprocess_image(image, config)
+    assert processed.shape == (32, 32)
+    assert processed.dtype == np.float32
+    assert processed[0, 0] == 0
+
+
+def test_normalise_constant_background():
+    with pytest.raises(ValueError):
+        normalise(np.ones((32, 32)), background_radius=8)
+    with pytest.raises(ValueError):
+        normalise(np.random.default_rng(0).normal(size=(32, 32)), background_radius=32)
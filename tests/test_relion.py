@@ -0,0 +1,58 @@
+import mrcfile
+import numpy as np
+
+from spsim.relion import (
+    append_particle_to_star,
+    count_star_particles,
+    create_mrcs_shards,
+    image_name,
+    optics_data,
+    particle_data,
+    save_image_into_mrcs_shard,
+    shard_location,
+    shard_sizes,
+    write_star_header,
+)
+
+EULERS = {'rlnAngleRot': 10.0, 'rlnAngleTilt': 20.0, 'rlnAnglePsi': 30.0}
+
+
+def test_image_name_is_one_indexed():
+    assert image_name(0, 'particles.mrcs') == '000001@particles.mrcs'
+
+
+def test_shards():
+    assert shard_sizes(25, images_per_shard=10) == [10, 10, 5]
+    assert shard_location(23, images_per_shard=10) == (2, 3)
+
+
+def test_incremental_star_file(tmp_path):
+    star_file = tmp_path / 'particles.star'
+    write_star_header(star_file, optics=optics_data(128, pixel_size=2.0))
+    assert count_star_particles(star_file) == 0
+
+    for idx in range(3):
+        particle = particle_data(
+            name=image_name(idx, 'particles.mrcs'), eulers=EULERS, defocus=1.5
+        )
+        append_particle_to_star(star_file, particle)
+    assert count_star_particles(star_file) == 3
+
+    # retried images are not appended twice
+    assert append_particle_to_star(star_file, particle, skip_if_present=True) is False
+    assert count_star_particles(star_file) == 3
+
+
+def test_save_image_into_single_image_shard(tmp_path):
+    mrcs_files = [str(tmp_path / f'particles_{i:04d}.mrcs') for i in range(2)]
+    create_mrcs_shards(
+        mrcs_files,
+        sizes=shard_sizes(3, images_per_shard=2),
+        image_sidelength=16,
+        dtype='float32',
+        pixel_size=1.0,
+    )
+    image = np.full((16, 16), fill_value=2, dtype=np.float32)
+    save_image_into_mrcs_shard(image, idx=0, mrcs_file=mrcs_files[1])
+    with mrcfile.open(mrcs_files[1]) as mrc:
+        assert np.array_equal(mrc.data.reshape(-1, 16, 16)[0], image)
@@ -1,5 +1,21 @@
+import json
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+import pytest
+from dask.distributed import Client, LocalCluster, Worker
+
 import spsim.simulation_functions
-from spsim.simulation_functions import simulate_single_image
+from spsim.simulation_functions import (
+    ParakeetStageError,
+    classify_failure,
+    execute,
+    run_stage,
+    simulate_single_image,
+)
 from .test_data_model import test_image_parameters_instantiation, \
     test_simulation_from_input_parameters
 
@@ -13,3 +29,103 @@ def test_simulate_image():
 def test_execute_simulation():
     simulation = test_simulation_from_input_parameters()
     spsim.simulation_functions.simulation_as_dask_array()
+
+
+def test_simulation_dask_array_graph_size():
+    simulation = test_simulation_from_input_parameters()
+    array = simulation.as_dask_array(images_per_chunk=16)
+    assert array.shape == (200, 512, 512)
+    assert array.chunks[0] == (16,) * 12 + (8,)
+
+    # simulation object, blockwise simulation and blockwise post-processing
+    assert len(array.__dask_graph__().layers) == 3
+
+
+def test_simulation_dask_array_compute(monkeypatch):
+    def fake_parakeet(simulation, idx):
+        return np.full((512, 512), idx, dtype=np.float32)
+
+    monkeypatch.setattr(spsim.simulation_functions, 'run_parakeet', fake_parakeet)
+    simulation = test_simulation_from_input_parameters()
+    images = simulation.as_dask_array(images_per_chunk=16)[14:18].compute()
+    assert np.array_equal(images[:, 0, 0], [14, 15, 16, 17])
+
+
+def test_run_stage_failure():
+    with pytest.raises(ParakeetStageError) as exc_info:
+        run_stage([sys.executable, '-c', 'import sys; sys.exit("GPU out of memory")'])
+    assert exc_info.value.returncode == 1
+    assert 'GPU out of memory' in exc_info.value.stderr
+    assert classify_failure(exc_info.value) == 'retryable'
+    assert classify_failure(ValueError()) == 'fatal'
+
+
+def test_execute_retries_failures(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    attempts = Counter()
+
+    def flaky_parakeet(simulation, idx):
+        attempts[idx] += 1
+        if idx == 1 and attempts[idx] == 1:
+            raise ParakeetStageError('parakeet.simulate.image', -9, 'killed')
+        if idx == 2:
+            raise ValueError('bad structure')
+        return np.zeros((512, 512), dtype=np.float32)
+
+    monkeypatch.setattr(spsim.simulation_functions, 'run_parakeet', flaky_parakeet)
+    simulation = test_simulation_from_input_parameters()
+    simulation.config.n_images = 4
+    simulation.per_image_parameters = simulation.per_image_parameters[:4]
+    simulation.config.output_basename = str(tmp_path / 'test')
+
+    with Client(processes=False, n_workers=1, dashboard_address=None) as client:
+        outcomes = execute(simulation, client, max_retries=2, retry_delay=0.01)
+
+    assert [outcome.status for outcome in outcomes] == [
+        'success', 'success', 'fatal', 'success'
+    ]
+    assert outcomes[1].attempt == 2
+    assert attempts[2] == 1  # fatal failures are not retried
+
+    with open(simulation.failure_manifest_filename) as f:
+        manifest = json.load(f)
+    assert manifest['n_failed'] == 1
+    assert 'bad structure' in manifest['failures'][0]['error']
+
+
+def test_execute_survives_worker_replacement(monkeypatch, tmp_path):
+    """Workers start after submission and are replaced mid-run, as on SLURM."""
+    monkeypatch.chdir(tmp_path)
+
+    def slow_parakeet(simulation, idx):
+        time.sleep(0.2)
+        return np.zeros((512, 512), dtype=np.float32)
+
+    monkeypatch.setattr(spsim.simulation_functions, 'run_parakeet', slow_parakeet)
+    simulation = test_simulation_from_input_parameters()
+    simulation.config.n_images = 8
+    simulation.per_image_parameters = simulation.per_image_parameters[:8]
+    simulation.config.output_basename = str(tmp_path / 'test')
+
+    cluster = LocalCluster(n_workers=0, processes=False, dashboard_address=None)
+    with cluster, Client(cluster) as client:
+        async def start_worker():
+            return await Worker(cluster.scheduler_address, nthreads=1)
+
+        workers = []
+        threading.Timer(3, lambda: workers.append(client.sync(start_worker))).start()
+
+        def replace_worker(n_succeeded, n_failed):
+            # close the first worker abruptly, losing the data it holds
+            if len(workers) == 1:
+                workers.append(client.sync(start_worker))
+                client.sync(workers[0].close)
+
+        outcomes = execute(
+            simulation, client, max_retries=1, retry_delay=0.01, progress=replace_worker
+        )
+        for worker in workers[1:]:
+            client.sync(worker.close)
+
+    assert len(workers) == 2
+    assert [outcome.status for outcome in outcomes] == ['success'] * 8
@@ -0,0 +1,82 @@
+from unittest import mock
+
+import numpy as np
+
+from spsim.data_model import PostProcessingConfig, SimulationConfig
+from spsim.statistics import (
+    create_statistics_directory,
+    histogram_edges,
+    image_statistics,
+    merge_moments,
+    save_image_statistics,
+    summarise_statistics,
+)
+from .constants import TEST_DATA_DIR
+
+
+def test_image_statistics():
+    image = np.arange(64, dtype=np.float32).reshape(8, 8)
+    statistics = image_statistics(
+        image, histogram_edges=histogram_edges(4, (0, 40)), thumbnail_sidelength=4
+    )
+    assert statistics['thumbnail'].shape == (4, 4)
+    assert statistics['histogram'].sum() == 64
+    assert statistics['histogram'][-1] == 24  # values >= 40 overflow
+
+    merged = merge_moments(statistics['moments'][np.newaxis])
+    assert np.isclose(merged['mean'], image.mean())
+    assert np.isclose(merged['std'], image.std())
+
+
+def test_summarise_statistics(tmp_path):
+    directory = str(tmp_path / 'test.stats')
+    defoci = np.array([1.0, 1.5, 3.0, 3.5])
+    create_statistics_directory(
+        directory,
+        n_images=4,
+        n_histogram_bins=8,
+        histogram_range=(-4, 4),
+        thumbnail_sidelength=8,
+        defoci=defoci,
+    )
+    rng = np.random.default_rng(0)
+    # two processes, image 1 is retried and the last image is not yet simulated
+    for process_id, indices in (('host_a', [0, 1]), ('host_b', [1, 2])):
+        with mock.patch('spsim.statistics._process_id', process_id):
+            for idx in indices:
+                statistics = image_statistics(
+                    rng.normal(size=(16, 16)),
+                    histogram_edges=histogram_edges(8, (-4, 4)),
+                    thumbnail_sidelength=8,
+                )
+                save_image_statistics(statistics, idx=idx, directory=directory)
+    assert len(list((tmp_path / 'test.stats' / 'records').iterdir())) == 2
+
+    summary = summarise_statistics(directory, n_defocus_bins=2)
+    assert summary['n_images_completed'] == 3
+    assert sum(summary['histogram']) == 3 * 16 * 16
+    assert summary['defocus_bin_counts'] == [2, 1]
+    assert summary['defocus_averages'].shape == (2, 8, 8)
+
+
+def test_histogram_range_from_postprocessing():
+    def histogram_range(**kwargs):
+        config = SimulationConfig(
+            input_directory=TEST_DATA_DIR / 'trajectory',
+            output_basename='test',
+            n_images=1,
+            image_sidelength=64,
+            defocus_range=(0.5, 4.5),
+            **kwargs,
+        )
+        return config.histogram_range
+
+    # inverted counts of 30 electrons per pixel
+    low, high = histogram_range()
+    assert low < -30 < high <= 0
+    assert histogram_range(postprocessing=PostProcessingConfig(normalise=True)) == (
+        -10, 10
+    )
+    low, high = histogram_range(noiseless=True)
+    assert low < 1 < high
+    assert histogram_range(statistics={'histogram_range': (-1, 1)}) == (-1, 1)